@@ -0,0 +1,80 @@
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+import json
+import os
+import random
+import uuid
+
+__all__ = ["generate_collection"]
+
+EVENT_TEMPLATE = """BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//DALEC//BENCHMARKS//EN
+BEGIN:VEVENT
+UID:{uid}
+DTSTART:{start:%Y%m%dT%H%M%SZ}
+DTEND:{end:%Y%m%dT%H%M%SZ}
+CREATED:{created:%Y%m%dT%H%M%SZ}
+DTSTAMP:{last_modified:%Y%m%dT%H%M%SZ}
+LAST-MODIFIED:{last_modified:%Y%m%dT%H%M%SZ}
+SUMMARY:Benchmark event {index} of calendar {calendar}
+DESCRIPTION:{description}
+LOCATION:Room {room}\\, Grenoble
+{rrule}STATUS:CONFIRMED
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+def generate_collection(
+    path: str,
+    username: str = "test",
+    nb_calendars: int = 10,
+    nb_events: int = 1000,
+    recurring_ratio: float = 0.1,
+    seed: int = 42,
+) -> list:
+    """
+    Generate a Radicale (multifilesystem storage) collection of `nb_calendars` calendars of
+    `nb_events` events each into `path`. About `recurring_ratio` of events are weekly recurring
+    events. Events start between a month ago and 10 months later. The same seed always
+    generates the same collection.
+    Returns the paths of calendars relative to the principal's collection.
+    """
+    rand = random.Random(seed)
+    now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    principal_path = os.path.join(path, "collection-root", username)
+    calendars = []
+    for calendar_index in range(nb_calendars):
+        calendar = str(uuid.UUID(int=rand.getrandbits(128)))
+        calendar_path = os.path.join(principal_path, calendar)
+        os.makedirs(calendar_path)
+        with open(os.path.join(calendar_path, ".Radicale.props"), "w") as props_file:
+            json.dump(
+                {"D:displayname": "Calendar {}".format(calendar_index), "tag": "VCALENDAR"},
+                props_file,
+            )
+        for index in range(nb_events):
+            uid = str(uuid.UUID(int=rand.getrandbits(128)))
+            start = now + timedelta(hours=rand.randint(-30 * 24, 300 * 24))
+            created = now - timedelta(days=rand.randint(1, 365))
+            recurring = rand.random() < recurring_ratio
+            data = EVENT_TEMPLATE.format(
+                uid=uid,
+                index=index,
+                calendar=calendar_index,
+                start=start,
+                end=start + timedelta(hours=rand.randint(1, 4)),
+                created=created,
+                last_modified=created + (now - created) * rand.random(),
+                description=" ".join(
+                    rand.choice(("Dalek", "Tardis", "Cyberman")) for _ in range(20)
+                ),
+                room=rand.randint(1, 100),
+                rrule="RRULE:FREQ=WEEKLY;COUNT=20\n" if recurring else "",
+            )
+            with open(os.path.join(calendar_path, "{}.ics".format(uid)), "w") as event_file:
+                event_file.write(data.replace("\n", "\r\n"))
+        calendars.append(calendar)
+    return calendars
@@ -0,0 +1,166 @@
+from contextlib import contextmanager
+import statistics
+import threading
+import time
+import tracemalloc
+from unittest import mock
+
+from django.core.cache import caches
+from requests.adapters import HTTPAdapter
+
+from dalec import settings as app_settings
+from dalec.proxy import ProxyPool
+from dalec_caldav.cache import contents_cache
+from dalec_caldav.proxy import CaldavProxy
+
+__all__ = ["Measurement", "measure", "run_benchmarks", "format_results"]
+
+
+class Measurement:
+    """
+    Metrics of one refresh
+    """
+
+    def __init__(self):
+        self.wall_time = 0.0
+        self.parse_time = 0.0
+        self.nb_requests = 0
+        self.bytes_sent = 0
+        self.peak_memory = None
+        self.nb_contents = 0
+        self._responses = []
+        self._lock = threading.Lock()
+
+    @property
+    def bytes_received(self):
+        # bytes read from the socket (streamed responses are only read once consumed)
+        return sum(response.raw.tell() for response in self._responses)
+
+    def as_dict(self):
+        return {
+            "wall_time": self.wall_time,
+            "parse_time": self.parse_time,
+            "nb_requests": self.nb_requests,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "peak_memory": self.peak_memory,
+            "nb_contents": self.nb_contents,
+        }
+
+
+@contextmanager
+def measure(trace_memory=False):
+    """
+    Count HTTP requests sent through `requests`, their bytes and the time spent to parse and
+    populate contents while the context is active.
+    """
+    measurement = Measurement()
+    send = HTTPAdapter.send
+    populate_contents = CaldavProxy._populate_calendar_contents
+
+    def measured_send(adapter, request, **kwargs):
+        response = send(adapter, request, **kwargs)
+        body = request.body or b""
+        with measurement._lock:
+            measurement.nb_requests += 1
+            measurement.bytes_sent += len(body.encode() if isinstance(body, str) else body)
+            measurement._responses.append(response)
+        return response
+
+    def measured_populate_contents(proxy, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return populate_contents(proxy, *args, **kwargs)
+        finally:
+            with measurement._lock:
+                measurement.parse_time += time.perf_counter() - start
+
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        with mock.patch.object(HTTPAdapter, "send", measured_send), mock.patch.object(
+            CaldavProxy, "_populate_calendar_contents", measured_populate_contents
+        ):
+            yield measurement
+    finally:
+        measurement.wall_time = time.perf_counter() - start
+        if trace_memory:
+            measurement.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+
+def _reset():
+    caches[app_settings.get_setting("CALDAV_CACHE", "default")].clear()
+    contents_cache.clear()
+    ProxyPool.get("caldav").content_model.objects.all().delete()
+
+
+def _refresh(measurement, channel=None, channel_object=None):
+    proxy = ProxyPool.get("caldav")
+    proxy.refresh("event", channel, channel_object, force=True)
+    measurement.nb_contents = proxy.get_contents_queryset("event", channel, channel_object).count()
+
+
+def run_benchmarks(repeat=3, channel=None, channel_object=None):
+    """
+    Refresh events `repeat` times from scratch ("cold": caches and contents are cleared
+    before) and `repeat` times again without clearing anything ("warm").
+    Peak memory is measured during an extra cold refresh, as tracing allocations slows it.
+    Returns the measurements of each scenario.
+    """
+    # the first requests make Radicale build its own cache: they are not measured
+    _reset()
+    _refresh(Measurement(), channel, channel_object)
+    results = {"cold": [], "warm": []}
+    for _ in range(repeat):
+        _reset()
+        with measure() as measurement:
+            _refresh(measurement, channel, channel_object)
+        results["cold"].append(measurement)
+        with measure() as measurement:
+            _refresh(measurement, channel, channel_object)
+        results["warm"].append(measurement)
+    _reset()
+    with measure(trace_memory=True) as measurement:
+        _refresh(measurement, channel, channel_object)
+    results["memory"] = [measurement]
+    return results
+
+
+def format_results(results):
+    """
+    Format medians of measurements as a table
+    """
+    lines = [
+        "{:<8} {:>9} {:>9} {:>9} {:>9} {:>12} {:>12} {:>10}".format(
+            "",
+            "contents",
+            "wall (s)",
+            "parse (s)",
+            "requests",
+            "sent (B)",
+            "received (B)",
+            "peak (MiB)",
+        )
+    ]
+    for scenario, measurements in results.items():
+        metrics = [measurement.as_dict() for measurement in measurements]
+
+        def median(key):
+            return statistics.median(m[key] for m in metrics)
+
+        peak_memory = metrics[0]["peak_memory"]
+        lines.append(
+            "{:<8} {:>9.0f} {:>9.3f} {:>9.3f} {:>9.0f} {:>12.0f} {:>12.0f} {:>10}".format(
+                scenario,
+                median("nb_contents"),
+                median("wall_time"),
+                median("parse_time"),
+                median("nb_requests"),
+                median("bytes_sent"),
+                median("bytes_received"),
+                "-" if peak_memory is None else "{:.1f}".format(peak_memory / 2**20),
+            )
+        )
+    return "\n".join(lines)
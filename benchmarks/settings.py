@@ -0,0 +1,9 @@
+from tests.settings import *  # noqa: F401,F403
+
+# the benchmarks Radicale server does not use the port of tests one
+BENCHMARKS_RADICALE_HOST = "localhost:5233"
+DALEC_CALDAV_BASE_URL = "http://{}/test/".format(BENCHMARKS_RADICALE_HOST)
+# contents are always refreshed
+DALEC_TTL = 0
+
+DATABASES = {"default": {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}}
@@ -0,0 +1,273 @@
+# Future imports
+from __future__ import annotations
+
+# Standard libs
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from asyncio import AbstractEventLoop
+    from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union
+
+    from .clients import ClientKey
+
+import asyncio
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from urllib.parse import quote
+from urllib.parse import urlparse
+import weakref
+
+# Django imports
+from django.core.exceptions import ImproperlyConfigured
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+
+# DALEC imports
+from caldav.davclient import DAVResponse
+from caldav.elements import cdav
+from caldav.elements import dav
+from caldav.elements.base import BaseElement
+from caldav.lib import error
+from caldav.lib.url import URL
+from caldav.objects import errmsg
+from dalec import settings as app_settings
+from lxml import etree
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None  # type: ignore
+
+# Local Apps
+from .clients import clients
+from .metrics import incr
+
+__all__ = ["AsyncClientManager", "AsyncDAVClient", "aclients"]
+
+# clients (and their http clients) of the current `AsyncClientManager.scope`
+_scope: ContextVar[
+    Optional[Tuple[Dict[ClientKey, AsyncDAVClient], Dict[ClientKey, httpx.AsyncClient]]]
+] = ContextVar("dalec_caldav_aclients_scope", default=None)
+
+
+class AsyncDAVClient:
+    """
+    Minimal asynchronous CalDav client built on httpx. It only sends the PROPFIND and REPORT
+    requests needed by `CaldavProxy._afetch` and returns caldav's `DAVResponse` so responses are
+    parsed the same way than with the synchronous `DAVClient`.
+    """
+
+    def __init__(
+        self,
+        http_client: httpx.AsyncClient,
+        url: str,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> None:
+        self.http_client = http_client
+        self.url = URL.objectify(url)
+        self.username = username
+        self.password = password
+        self.headers = {"Content-Type": 'text/xml; charset="utf-8"', **(headers or {})}
+        self.auth: Optional[httpx.Auth] = None
+
+    async def request(
+        self, url: Union[str, URL], method: str = "GET", body: bytes = b"", depth: int = 0
+    ) -> DAVResponse:
+        headers = dict(self.headers, Depth=str(depth))
+        response = await self.http_client.request(
+            method,
+            str(url),
+            content=body,
+            headers=headers,
+            auth=self.auth or httpx.USE_CLIENT_DEFAULT,
+        )
+        if (
+            response.status_code == 401
+            and self.auth is None
+            and self.username
+            and self.password
+            and "WWW-Authenticate" in response.headers
+        ):
+            # negotiate the authentication like DAVClient does
+            auth_types = response.headers["WWW-Authenticate"].lower()
+            if "digest" in auth_types:
+                self.auth = httpx.DigestAuth(self.username, self.password)
+            elif "basic" in auth_types:
+                self.auth = httpx.BasicAuth(self.username, self.password)
+            else:
+                raise NotImplementedError(
+                    "The server does not provide any of the currently supported authentication "
+                    "methods: basic, digest"
+                )
+            return await self.request(url, method, body, depth)
+        incr("requests")
+        incr("bytes_sent", len(body))
+        incr("bytes_received", len(response.content))
+        return DAVResponse(response)
+
+    async def query(
+        self, url: Union[str, URL], root: BaseElement, depth: int = 0, method: str = "propfind"
+    ) -> DAVResponse:
+        """
+        Send the XML query and raise caldav's errors like `DAVObject._query`
+        """
+        body = etree.tostring(root.xmlelement(), encoding="utf-8", xml_declaration=True)
+        response = await self.request(url, method.upper(), body, depth)
+        if response.status == 404:
+            raise error.NotFoundError(errmsg(response))
+        if response.status >= 400:
+            raise error.exception_by_method[method](errmsg(response))
+        return response
+
+    async def propfind(
+        self, url: Union[str, URL], props: List[BaseElement], depth: int = 0
+    ) -> DAVResponse:
+        return await self.query(url, dav.Propfind() + (dav.Prop() + props), depth, "propfind")
+
+    async def report(self, url: Union[str, URL], root: BaseElement, depth: int = 1) -> DAVResponse:
+        return await self.query(url, root, depth, "report")
+
+    async def get_property(self, url: Union[str, URL], prop: BaseElement) -> Any:
+        response = await self.propfind(url, [prop])
+        for props in response.expand_simple_props(props=[prop]).values():
+            return props[prop.tag]
+        return None
+
+    async def get_calendar_home_url(self) -> URL:
+        """
+        Discover the calendar home of the principal, like `DAVClient.principal().calendar_home_set`
+        """
+        principal_url = self.url.join(
+            URL.objectify(await self.get_property(self.url, dav.CurrentUserPrincipal()))
+        )
+        calendar_home_url = await self.get_property(principal_url, cdav.CalendarHomeSet())
+        if calendar_home_url is None:
+            raise error.NotFoundError("No calendar home for principal {}".format(principal_url))
+        if "@" in calendar_home_url and "://" not in calendar_home_url:
+            # same workaround than caldav for owncloud
+            calendar_home_url = quote(calendar_home_url)
+        return principal_url.join(URL.objectify(calendar_home_url))
+
+
+class AsyncClientManager:
+    """
+    Async counterpart of `ClientManager`: clients are built lazily and clients of the same host
+    using the same credentials share the same `httpx.AsyncClient` and its pool of connections.
+    httpx connections can not be shared between event loops: clients are kept until the end of
+    the current `scope` or, outside of any scope, per event loop until `aclose` is called.
+    """
+
+    def __init__(self) -> None:
+        self._clients: weakref.WeakKeyDictionary[
+            AbstractEventLoop, Dict[ClientKey, AsyncDAVClient]
+        ] = weakref.WeakKeyDictionary()
+        self._http_clients: weakref.WeakKeyDictionary[
+            AbstractEventLoop, Dict[ClientKey, httpx.AsyncClient]
+        ] = weakref.WeakKeyDictionary()
+
+    @asynccontextmanager
+    async def scope(self) -> AsyncIterator[None]:
+        """
+        Share clients built in the context (ie: by one refresh, concurrent tasks included) and
+        close their connections when it exits. Nested scopes use the outer one.
+        """
+        if _scope.get() is not None:
+            yield
+            return
+        scope_clients: Dict[ClientKey, AsyncDAVClient] = {}
+        scope_http_clients: Dict[ClientKey, httpx.AsyncClient] = {}
+        token = _scope.set((scope_clients, scope_http_clients))
+        try:
+            yield
+        finally:
+            _scope.reset(token)
+            for http_client in scope_http_clients.values():
+                await http_client.aclose()
+
+    def get_client(
+        self,
+        url: Optional[str] = None,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+    ) -> AsyncDAVClient:
+        """
+        Return the async DAV client of the current scope (or of the running event loop) for the
+        given base url and credentials (see `ClientManager.get_client`).
+        """
+        if httpx is None:
+            raise ImproperlyConfigured(
+                "httpx is required to fetch calendars asynchronously: "
+                "pip install dalec-caldav[async]"
+            )
+        key = clients.get_credentials() if url is None else (url, username, password)
+        scope = _scope.get()
+        if scope is not None:
+            loop_clients, loop_http_clients = scope
+        else:
+            loop = asyncio.get_running_loop()
+            loop_clients = self._clients.setdefault(loop, {})
+            loop_http_clients = self._http_clients.setdefault(loop, {})
+        client = loop_clients.get(key)
+        if client is None:
+            headers = {}
+            if not app_settings.get_setting("CALDAV_KEEP_ALIVE", True):
+                headers["Connection"] = "close"
+            client = AsyncDAVClient(
+                self._get_http_client(loop_http_clients, key), *key, headers=headers
+            )
+            loop_clients[key] = client
+        return client
+
+    def get_client_for_url(self, url: str) -> AsyncDAVClient:
+        """
+        Return the async DAV client to use to query the given calendar url (see
+        `ClientManager.get_credentials_for_url`)
+        """
+        return self.get_client(*clients.get_credentials_for_url(url))
+
+    def _get_http_client(
+        self, http_clients: Dict[ClientKey, httpx.AsyncClient], key: ClientKey
+    ) -> httpx.AsyncClient:
+        url_obj = urlparse(key[0])
+        key = ("{}://{}".format(url_obj.scheme, url_obj.netloc), key[1], key[2])
+        http_client = http_clients.get(key)
+        if http_client is None:
+            pool_size = app_settings.get_setting("CALDAV_CONNECTION_POOL_SIZE", 10)
+            timeout = app_settings.get_setting("CALDAV_TIMEOUT", None)
+            if isinstance(timeout, tuple):
+                timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+            http_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=pool_size), timeout=timeout
+            )
+            http_clients[key] = http_client
+        return http_client
+
+    async def aclose(self) -> None:
+        """
+        Close the connections of clients of the running event loop (built outside of a scope)
+        """
+        loop = asyncio.get_running_loop()
+        self._clients.pop(loop, None)
+        for http_client in self._http_clients.pop(loop, {}).values():
+            await http_client.aclose()
+
+    def clear(self) -> None:
+        """
+        Forget every client. Their connections are closed when they are garbage collected.
+        """
+        self._clients = weakref.WeakKeyDictionary()
+        self._http_clients = weakref.WeakKeyDictionary()
+
+
+aclients = AsyncClientManager()
+
+
+@receiver(setting_changed)
+def clear_aclients(setting: str, **kwargs: Any) -> None:
+    """
+    Forget async clients built with outdated settings (mainly useful for tests)
+    """
+    if setting.startswith("DALEC_CALDAV_"):
+        aclients.clear()
@@ -0,0 +1,141 @@
+# Future imports
+from __future__ import annotations
+
+# Standard libs
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Optional, Tuple, Type
+
+from urllib.parse import urljoin
+from urllib.parse import urlparse
+import time
+
+# Django imports
+from django.conf import settings
+
+# DALEC imports
+from dalec import settings as app_settings
+from requests.exceptions import ConnectionError
+from requests.exceptions import Timeout
+
+# Local Apps
+from .cache import get_cache
+from .cache import make_key
+
+__all__ = [
+    "NETWORK_ERRORS",
+    "CircuitOpenError",
+    "acquire_probe",
+    "get_server",
+    "is_open",
+    "record_failure",
+    "record_success",
+    "release_probe",
+]
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None  # type: ignore
+
+# errors meaning the CalDav server is unreachable (HTTP errors are not counted)
+NETWORK_ERRORS: Tuple[Type[Exception], ...] = (ConnectionError, Timeout)
+if httpx is not None:
+    NETWORK_ERRORS += (httpx.TransportError,)
+
+
+class CircuitOpenError(Exception):
+    """
+    The circuit of the CalDav server is open: its calendars were not refreshed
+    """
+
+    def __init__(self, server: str) -> None:
+        super().__init__(server)
+        self.server = server
+
+    def __str__(self) -> str:
+        return "circuit open, {} is unreachable".format(self.server)
+
+
+def get_server(channel: Optional[str], channel_object: Optional[str]) -> str:
+    """
+    Return the "scheme://host" of the CalDav server queried to refresh the channel object
+    """
+    url = settings.DALEC_CALDAV_BASE_URL
+    if channel == "url" and channel_object:
+        url = urljoin(url, channel_object)
+    url_obj = urlparse(url)
+    return "{}://{}".format(url_obj.scheme, url_obj.netloc)
+
+
+def _get_timeout() -> int:
+    # failures which are not followed by others are forgotten after a while
+    return max(app_settings.get_setting("CALDAV_CIRCUIT_BREAKER_MAX_BACKOFF", 600) * 2, 3600)
+
+
+def is_open(server: str) -> bool:
+    """
+    Return True if the server failed `DALEC_CALDAV_CIRCUIT_BREAKER_THRESHOLD` times in a row:
+    it should not be queried until a probe succeeds.
+    """
+    threshold = app_settings.get_setting("CALDAV_CIRCUIT_BREAKER_THRESHOLD", 0)
+    if not threshold:
+        return False
+    return get_cache().get(make_key("breaker_failures", server), 0) >= threshold
+
+
+def record_failure(server: str) -> None:
+    """
+    Count a failure of the server. Once the circuit is open, each failure doubles the delay
+    before the next probe, from `DALEC_CALDAV_CIRCUIT_BREAKER_BACKOFF` up to
+    `DALEC_CALDAV_CIRCUIT_BREAKER_MAX_BACKOFF` seconds.
+    """
+    threshold = app_settings.get_setting("CALDAV_CIRCUIT_BREAKER_THRESHOLD", 0)
+    if not threshold:
+        return
+    cache = get_cache()
+    timeout = _get_timeout()
+    key = make_key("breaker_failures", server)
+    # failures are counted atomically: processes may fail at the same time
+    cache.add(key, 0, timeout)
+    try:
+        failures = cache.incr(key)
+    except ValueError:
+        # the key expired in between
+        cache.add(key, 1, timeout)
+        failures = 1
+    cache.touch(key, timeout)
+    if failures >= threshold:
+        backoff = app_settings.get_setting("CALDAV_CIRCUIT_BREAKER_BACKOFF", 30)
+        backoff *= 2 ** min(failures - threshold, 32)
+        backoff = min(backoff, app_settings.get_setting("CALDAV_CIRCUIT_BREAKER_MAX_BACKOFF", 600))
+        cache.set(make_key("breaker_retry_at", server), time.time() + backoff, timeout)
+
+
+def record_success(server: str) -> None:
+    """
+    Close the circuit of the server
+    """
+    cache = get_cache()
+    if cache.get(make_key("breaker_failures", server)) is not None:
+        cache.delete_many(
+            [make_key("breaker_failures", server), make_key("breaker_retry_at", server)]
+        )
+
+
+def acquire_probe(server: str) -> bool:
+    """
+    Return True if the server should be probed: the circuit is open, the backoff delay elapsed
+    and no other probe is running (in any process).
+    """
+    retry_at = get_cache().get(make_key("breaker_retry_at", server))
+    if retry_at is None or time.time() < retry_at or not is_open(server):
+        return False
+    # the lock expires in case the probe never ends
+    timeout = max(app_settings.get_setting("CALDAV_CIRCUIT_BREAKER_MAX_BACKOFF", 600), 60)
+    return get_cache().add(make_key("probe", server), True, timeout)
+
+
+def release_probe(server: str) -> None:
+    get_cache().delete(make_key("probe", server))
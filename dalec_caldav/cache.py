@@ -0,0 +1,227 @@
+# Future imports
+from __future__ import annotations
+
+# Standard libs
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Any, Callable, Dict, Hashable, Optional, TypeVar
+    from django.core.cache.backends.base import BaseCache
+
+    R = TypeVar("R")
+
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+from uuid import uuid4
+
+# Django imports
+from django.core.cache import caches
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+
+# DALEC imports
+from dalec import settings as app_settings
+
+
+def get_cache() -> BaseCache:
+    """
+    Return the django cache used by dalec_caldav (see `DALEC_CALDAV_CACHE` setting)
+    """
+    return caches[app_settings.get_setting("CALDAV_CACHE", "default")]
+
+
+def make_key(prefix: str, *parts: Optional[str]) -> str:
+    """
+    Build a cache key from a prefix and some (potentially long) parts like urls.
+    Parts are hashed to always get a valid key for every cache backend.
+    """
+    digest = hashlib.md5("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+    return "dalec_caldav:{}:{}".format(prefix, digest)
+
+
+def get_calendar_infos(url: str) -> Optional[Dict[str, Any]]:
+    """
+    Return cached infos (display name, type…) of the calendar or None if they are not cached
+    """
+    return get_cache().get(make_key("infos", url))
+
+
+def set_calendar_infos(url: str, infos: Dict[str, Any]) -> None:
+    """
+    Cache infos of the calendar for `DALEC_CALDAV_CALENDAR_INFOS_TTL` seconds
+    """
+    ttl = app_settings.get_setting("CALDAV_CALENDAR_INFOS_TTL", 3600)
+    if ttl:
+        get_cache().set(make_key("infos", url), infos, ttl)
+
+
+def invalidate_calendar_infos(*urls: str) -> None:
+    """
+    Remove cached infos of the given calendars: they will be fetched again on next refresh.
+    """
+    get_cache().delete_many([make_key("infos", url) for url in urls])
+
+
+def get_calendar_fields(url: str) -> Optional[Dict[str, Any]]:
+    """
+    Return cached calendar-level fields of contents (display name…) stored once per calendar
+    with `DALEC_CALDAV_COMPACT_CALENDAR_FIELDS` or None if they are not cached
+    """
+    return get_cache().get(make_key("calendar", url))
+
+
+def set_calendar_fields(url: str, fields: Dict[str, Any]) -> None:
+    """
+    Cache calendar-level fields of contents without expiration: they are needed as long as
+    contents of the calendar are stored (they are also stored in the database, if evicted).
+    """
+    get_cache().set(make_key("calendar", url), fields, None)
+
+
+def get_discovery(url: str, username: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    Return the cached calendar home and calendars discovered for the principal of the given
+    CalDav account or None if they are not cached
+    """
+    return get_cache().get(make_key("discovery", url, username))
+
+
+def set_discovery(url: str, username: Optional[str], discovery: Dict[str, Any]) -> None:
+    """
+    Cache the calendar home and calendars of the principal for `DALEC_CALDAV_DISCOVERY_TTL`
+    seconds
+    """
+    ttl = app_settings.get_setting("CALDAV_DISCOVERY_TTL", 3600)
+    if ttl:
+        get_cache().set(make_key("discovery", url, username), discovery, ttl)
+
+
+def invalidate_discovery(url: str, username: Optional[str]) -> None:
+    """
+    Remove the cached calendar home and calendars of the principal: they will be discovered
+    again on next refresh.
+    """
+    get_cache().delete(make_key("discovery", url, username))
+
+
+def get_snapshot(
+    content_type: str, channel: Optional[str], channel_object: Optional[str]
+) -> Optional[Dict[str, str]]:
+    """
+    Return fingerprints of contents stored by the previous refresh in delta mode, by content id
+    """
+    return get_cache().get(make_key("snapshot", content_type, channel, channel_object))
+
+
+def set_snapshot(
+    content_type: str,
+    channel: Optional[str],
+    channel_object: Optional[str],
+    snapshot: Dict[str, str],
+) -> None:
+    """
+    Store fingerprints of stored contents for `DALEC_CALDAV_DELTA_SNAPSHOT_TTL` seconds: after
+    that, every content is given to dalec again.
+    """
+    ttl = app_settings.get_setting("CALDAV_DELTA_SNAPSHOT_TTL", 86400)
+    get_cache().set(make_key("snapshot", content_type, channel, channel_object), snapshot, ttl)
+
+
+def call_once(key: str, func: Callable[[], R], timeout: float) -> R:
+    """
+    Call `func` in only one process at a time for the given key, using a lock stored in the
+    cache: other processes wait (at most `timeout` seconds) for its result, which is shared
+    through the cache, instead of calling their own `func`.
+    If the lock owner fails or is too slow, waiting processes call `func` themselves.
+    """
+    cache = get_cache()
+    lock_key = make_key("lock", key)
+    token = uuid4().hex
+    deadline = time.monotonic() + timeout
+    missing = object()
+    while time.monotonic() < deadline:
+        if cache.add(lock_key, token, timeout):
+            try:
+                result = func()
+                cache.set(make_key("result", key, token), result, timeout)
+            finally:
+                cache.delete(lock_key)
+            return result
+        owner = cache.get(lock_key)
+        while owner is not None and time.monotonic() < deadline:
+            time.sleep(0.05)
+            # the result is set before the lock is released: read the lock first
+            current_owner = cache.get(lock_key)
+            result = cache.get(make_key("result", key, owner), missing)
+            if result is not missing:
+                return result
+            # the owner failed (no result) or another process got the lock meanwhile
+            owner = current_owner
+    return func()
+
+
+class LRUCache:
+    """
+    Thread-safe in-memory LRU cache, bounded by the `DALEC_<maxsize_setting>` setting, which
+    counts its hits and misses.
+    """
+
+    def __init__(self, maxsize_setting: str, default_maxsize: int) -> None:
+        self.maxsize_setting = maxsize_setting
+        self.default_maxsize = default_maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._data: OrderedDict[Hashable, Any] = OrderedDict()
+
+    @property
+    def maxsize(self) -> int:
+        return app_settings.get_setting(self.maxsize_setting, self.default_maxsize)
+
+    def get(self, key: Hashable) -> Any:
+        """
+        Return the cached value or None if it is not cached
+        """
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        maxsize = self.maxsize
+        if maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+# populated contents of events, keyed by (event url, etag, calendar infos…)
+contents_cache = LRUCache("CALDAV_CONTENTS_CACHE_SIZE", 1000)
+
+
+@receiver(setting_changed)
+def clear_contents_cache(setting: str, **kwargs: Any) -> None:
+    """
+    Forget contents populated with outdated settings (mainly useful for tests)
+    """
+    if setting.startswith("DALEC_CALDAV_"):
+        contents_cache.clear()
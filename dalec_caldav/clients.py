@@ -0,0 +1,177 @@
+# Future imports
+from __future__ import annotations
+
+# Standard libs
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Any, Dict, Optional, Tuple
+
+    ClientKey = Tuple[str, Optional[str], Optional[str]]
+
+import threading
+from urllib.parse import urlparse
+import weakref
+
+# Django imports
+from django.conf import settings
+from django.test.signals import setting_changed
+from django.dispatch import receiver
+
+# DALEC imports
+from caldav.davclient import DAVClient
+from dalec import settings as app_settings
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+# Local Apps
+from .metrics import count_response
+
+__all__ = ["ClientManager", "clients"]
+
+
+class ClientManager:
+    """
+    Lazily build DAV clients keyed by (base url, username, password).
+
+    A DAVClient and its `requests.Session` hold some mutable state (negotiated auth, cookies,
+    discovered principal…) so each thread gets its own client and session, but sessions of all
+    clients of the same host using the same credentials share the same `HTTPAdapter` and its
+    (thread-safe) pool of keep-alive connections.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._adapters: Dict[ClientKey, HTTPAdapter] = {}
+        self._keys: weakref.WeakKeyDictionary[DAVClient, ClientKey] = weakref.WeakKeyDictionary()
+        self._generation = 0
+
+    def get_client(
+        self,
+        url: Optional[str] = None,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+    ) -> DAVClient:
+        """
+        Return the DAV client of the current thread for the given base url and credentials.
+        Without url, the client is built from `DALEC_CALDAV_BASE_URL`,
+        `DALEC_CALDAV_API_USERNAME` and `DALEC_CALDAV_API_PASSWORD` settings.
+        """
+        key = self.get_credentials() if url is None else (url, username, password)
+        if getattr(self._local, "generation", None) != self._generation:
+            self._local.clients = {}
+            self._local.generation = self._generation
+        client = self._local.clients.get(key)
+        if client is None:
+            client = self._build_client(key)
+            self._local.clients[key] = client
+        return client
+
+    def get_thread_client(self, client: DAVClient) -> DAVClient:
+        """
+        Return the client of the current thread equivalent to the given one (ie: the client of
+        calendars discovered by another thread). Clients which were not built by this manager
+        are returned as is.
+        """
+        key = self._keys.get(client)
+        return client if key is None else self.get_client(*key)
+
+    def get_client_for_url(self, url: str) -> DAVClient:
+        """
+        Return the DAV client to use to query the given calendar url (see
+        `get_credentials_for_url`)
+        """
+        return self.get_client(*self.get_credentials_for_url(url))
+
+    def get_credentials(self) -> ClientKey:
+        """
+        Return the default (base url, username, password), from `DALEC_CALDAV_BASE_URL`,
+        `DALEC_CALDAV_API_USERNAME` and `DALEC_CALDAV_API_PASSWORD` settings.
+        """
+        return (
+            settings.DALEC_CALDAV_BASE_URL,
+            settings.DALEC_CALDAV_API_USERNAME,
+            settings.DALEC_CALDAV_API_PASSWORD,
+        )
+
+    def get_credentials_for_url(self, url: str) -> ClientKey:
+        """
+        Return the (base url, username, password) to use to query the given calendar url:
+          - the ones of the longest matching url prefix of `DALEC_CALDAV_SERVERS`,
+          - or the default ones if url is on the same host than `DALEC_CALDAV_BASE_URL`,
+          - or anonymous ones for the url's host.
+        """
+        servers = app_settings.get_setting("CALDAV_SERVERS", {})
+        prefixes = [prefix for prefix in servers if url.startswith(prefix)]
+        if prefixes:
+            prefix = max(prefixes, key=len)
+            return (prefix, servers[prefix].get("username"), servers[prefix].get("password"))
+        url_obj = urlparse(url)
+        base_url_obj = urlparse(settings.DALEC_CALDAV_BASE_URL)
+        if (url_obj.scheme, url_obj.netloc) == (base_url_obj.scheme, base_url_obj.netloc):
+            return self.get_credentials()
+        return ("{}://{}/".format(url_obj.scheme, url_obj.netloc), None, None)
+
+    def _build_client(self, key: ClientKey) -> DAVClient:
+        url, username, password = key
+        headers = {}
+        if not app_settings.get_setting("CALDAV_KEEP_ALIVE", True):
+            headers["Connection"] = "close"
+        client = DAVClient(
+            url=url,
+            username=username,
+            password=password,
+            timeout=app_settings.get_setting("CALDAV_TIMEOUT", None),
+            # always give a new dict: DAVClient updates it in place
+            headers=headers,
+        )
+        client.session.close()
+        client.session = self._build_session(key)
+        with self._lock:
+            self._keys[client] = key
+        return client
+
+    def _build_session(self, key: ClientKey) -> Session:
+        """
+        Build the HTTP session of a client. Sessions of clients using the same credentials on
+        the same host share their adapter, and so their keep-alive connections.
+        """
+        url_obj = urlparse(key[0])
+        key = ("{}://{}".format(url_obj.scheme, url_obj.netloc), key[1], key[2])
+        with self._lock:
+            adapter = self._adapters.get(key)
+            if adapter is None:
+                pool_size = app_settings.get_setting("CALDAV_CONNECTION_POOL_SIZE", 10)
+                adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+                self._adapters[key] = adapter
+        session = Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.hooks["response"].append(count_response)
+        return session
+
+    def clear(self) -> None:
+        """
+        Close every pooled connection and forget every client, in every thread.
+        Clients will be rebuilt with current settings on next `get_client` calls.
+        """
+        with self._lock:
+            adapters = list(self._adapters.values())
+            self._adapters = {}
+            self._keys = weakref.WeakKeyDictionary()
+            self._generation += 1
+        for adapter in adapters:
+            adapter.close()
+
+
+clients = ClientManager()
+
+
+@receiver(setting_changed)
+def clear_clients(setting: str, **kwargs: Any) -> None:
+    """
+    Forget clients built with outdated settings (mainly useful for tests)
+    """
+    if setting.startswith("DALEC_CALDAV_"):
+        clients.clear()
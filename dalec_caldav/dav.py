@@ -0,0 +1,207 @@
+# Future imports
+from __future__ import annotations
+
+# Standard libs
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Iterable, Iterator, List, Optional, Tuple
+    from caldav.davclient import DAVClient, DAVResponse
+    import requests
+    from caldav.elements.base import BaseElement
+    from caldav.objects import Calendar
+
+from datetime import datetime
+from urllib.parse import quote
+
+# Django imports
+from django.utils.timezone import make_aware
+
+# DALEC imports
+from caldav.elements import cdav
+from caldav.elements import dav
+from caldav.lib import error
+from caldav.lib.url import URL
+from caldav.objects import Event
+from lxml import etree
+
+# Local Apps
+from .elements import CalendarProp
+from .parser import parse_vevent
+from .parser import UnsupportedData
+
+__all__ = [
+    "build_multiget_query",
+    "get_events_etags",
+    "get_events_from_response",
+    "get_last_update",
+    "iter_report",
+    "multiget_events",
+]
+
+
+def get_events_etags(
+    calendar: Calendar, start: Optional[datetime], end: Optional[datetime]
+) -> List[Tuple[URL, Optional[str], Optional[float]]]:
+    """
+    List events of the calendar in the given time range without their calendar data: only
+    their url, etag and last update timestamp are requested through a lightweight
+    calendar-query REPORT. The last update is the one dalec sorts contents by (iCalendar
+    LAST-MODIFIED, else CREATED, else DTSTAMP, not the WebDAV getlastmodified of the
+    resource), it is None if the event has none of them.
+    """
+    comp_filter = cdav.CompFilter("VEVENT")
+    if start is not None or end is not None:
+        # an empty time-range is invalid (RFC 4791, 9.9)
+        comp_filter += cdav.TimeRange(start, end)
+    # only properties giving the last update are requested (RFC 4791, 9.6 partial retrieval)
+    calendar_data = cdav.CalendarData() + (
+        cdav.Comp("VCALENDAR")
+        + (
+            cdav.Comp("VEVENT")
+            + [CalendarProp(name) for name in ("UID", "LAST-MODIFIED", "CREATED", "DTSTAMP")]
+        )
+    )
+    query = cdav.CalendarQuery() + [
+        dav.Prop() + [dav.GetEtag(), calendar_data],
+        cdav.Filter() + (cdav.CompFilter("VCALENDAR") + comp_filter),
+    ]
+    response = calendar._query(query, 1, "report")
+    properties = response.expand_simple_props(props=[dav.GetEtag(), cdav.CalendarData()])
+    events = []
+    for href, props in properties.items():
+        url = calendar.url.join(href)
+        if url == calendar.url:
+            continue
+        data = props[cdav.CalendarData.tag]
+        events.append((url, props[dav.GetEtag.tag], get_last_update(data) if data else None))
+    return events
+
+
+def get_last_update(data: str) -> Optional[float]:
+    """
+    Return the timestamp of the last update of the first VEVENT of the given calendar data,
+    like dalec_caldav computes `last_update_dt` of contents
+    """
+    try:
+        vevent = parse_vevent(data)
+    except UnsupportedData:
+        return None
+    for key in ("last-modified", "created", "dtstamp"):
+        value = vevent.get(key)
+        if isinstance(value, datetime):
+            return (make_aware(value) if value.tzinfo is None else value).timestamp()
+    return None
+
+
+def multiget_events(calendar: Calendar, urls: Iterable[URL], chunk_size: int) -> List[Event]:
+    """
+    Fetch the given events of the calendar with calendar-multiget REPORTs of at most
+    `chunk_size` hrefs each, instead of loading them one by one.
+    Events which do not exist anymore are skipped.
+    """
+    urls = list(urls)
+    events = []
+    for start in range(0, len(urls), chunk_size):
+        stop = start + chunk_size
+        response = calendar._query(build_multiget_query(urls[start:stop]), 1, "report")
+        events += get_events_from_response(calendar, response)
+    return events
+
+
+def build_multiget_query(urls: Iterable[URL]) -> cdav.CalendarMultiGet:
+    """
+    Build a calendar-multiget REPORT body requesting calendar data and etag of the given events
+    """
+    return (
+        cdav.CalendarMultiGet()
+        + (dav.Prop() + [dav.GetEtag(), cdav.CalendarData()])
+        + [dav.Href(value=url.path) for url in urls]
+    )
+
+
+def get_events_from_response(calendar: Calendar, response: DAVResponse) -> List[Event]:
+    """
+    Build events of the calendar from the multistatus response of a calendar-query or
+    calendar-multiget REPORT. Resources without calendar data are skipped.
+    """
+    events = []
+    properties = response.expand_simple_props(props=[dav.GetEtag(), cdav.CalendarData()])
+    for href, props in properties.items():
+        data = props.pop(cdav.CalendarData.tag)
+        if not data:
+            continue
+        url = URL(href)
+        if url.hostname is None:
+            # quote when result is not a full URL (like caldav does)
+            url = quote(href)
+        url = calendar.url.join(url)
+        if url == calendar.url:
+            continue
+        events.append(Event(calendar.client, url=url, data=data, parent=calendar, props=props))
+    return events
+
+
+def iter_report(
+    calendar: Calendar, query: BaseElement
+) -> Iterator[Tuple[URL, Optional[str], Optional[str]]]:
+    """
+    Send a REPORT query on the calendar and parse its multistatus response while it is
+    downloaded: (url, etag, calendar data) of each resource are yielded one at a time and
+    their XML elements are freed right after, so memory usage does not depend on the number of
+    resources (unlike `calendar._query` which builds the whole response tree).
+    """
+    client = calendar.client
+    body = etree.tostring(query.xmlelement(), encoding="utf-8", xml_declaration=True)
+    response = _stream_request(client, calendar.url, "REPORT", body, depth=1)
+    if response.status_code == 401 and client.auth is None and client.username:
+        response.close()
+        # let DAVClient negotiate the authentication method
+        client.propfind(calendar.url)
+        response = _stream_request(client, calendar.url, "REPORT", body, depth=1)
+    with response:
+        if response.status_code == 404:
+            raise error.NotFoundError("{} {}".format(response.status_code, response.reason))
+        if response.status_code >= 400:
+            raise error.ReportError("{} {}".format(response.status_code, response.reason))
+        response.raw.decode_content = True
+        elements = etree.iterparse(response.raw, events=("end",), tag="{DAV:}response")
+        for _, element in elements:
+            href = element.findtext("{DAV:}href")
+            etag = data = None
+            for propstat in element.iterfind("{DAV:}propstat"):
+                if " 200 " not in (propstat.findtext("{DAV:}status") or ""):
+                    continue
+                etag = propstat.findtext(".//{DAV:}getetag") or etag
+                data = propstat.findtext(".//" + cdav.CalendarData.tag) or data
+            # free the parsed response and every previous one
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+            if not href:
+                continue
+            url = URL(href)
+            if url.hostname is None:
+                url = quote(href)
+            url = calendar.url.join(url)
+            if url == calendar.url:
+                continue
+            # stray CRs are removed like caldav does
+            yield url, etag, data.replace("\r\n", "\n") if data else data
+
+
+def _stream_request(
+    client: DAVClient, url: URL, method: str, body: bytes, depth: int
+) -> requests.Response:
+    headers = dict(client.headers, Depth=str(depth))
+    return client.session.request(
+        method,
+        str(url),
+        data=body,
+        headers=headers,
+        auth=client.auth,
+        timeout=client.timeout,
+        verify=client.ssl_verify_cert,
+        cert=client.ssl_cert,
+        stream=True,
+    )
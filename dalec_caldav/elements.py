@@ -0,0 +1,25 @@
+# Future imports
+from __future__ import annotations
+
+# DALEC imports
+from caldav.elements.base import NamedBaseElement
+from caldav.elements.base import ValuedBaseElement
+from caldav.lib.namespace import ns
+
+
+class GetCTag(ValuedBaseElement):
+    """
+    CalendarServer's `getctag` property: an opaque token which changes each time the content
+    of a calendar collection changes.
+    """
+
+    tag = "{http://calendarserver.org/ns/}getctag"
+
+
+class CalendarProp(NamedBaseElement):
+    """
+    CalDav `prop` element of `calendar-data` (RFC 4791, 9.6.4): an iCalendar property of the
+    calendar components to return (partial retrieval).
+    """
+
+    tag = ns("C", "prop")
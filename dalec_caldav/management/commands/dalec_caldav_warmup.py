@@ -0,0 +1,74 @@
+# Future imports
+from __future__ import annotations
+
+# Standard libs
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Any
+
+    from django.core.management.base import CommandParser
+
+# Django imports
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+# Local Apps
+from ...breaker import CircuitOpenError
+from ...warmup import warmup
+
+
+class Command(BaseCommand):
+    help = (
+        "Refresh contents of calendars before users need them: the given channel objects or, "
+        "by default, every channel object already refreshed once (or the principal's calendars)."
+    )
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument(
+            "channel_objects",
+            nargs="*",
+            help="channel objects to refresh (ie: calendar urls with the default --channel)",
+        )
+        parser.add_argument(
+            "--channel", default="url", help="channel of the given channel objects (default: url)"
+        )
+        parser.add_argument("--content-type", default="event")
+        parser.add_argument(
+            "--workers", type=int, default=None, help="number of channel objects refreshed at once"
+        )
+        parser.add_argument(
+            "--no-force",
+            action="store_false",
+            dest="force",
+            help="do not refresh channel objects whose contents are not expired yet",
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        targets = None
+        if options["channel_objects"]:
+            targets = [
+                (options["channel"], channel_object)
+                for channel_object in options["channel_objects"]
+            ]
+        results = warmup(
+            targets,
+            content_type=options["content_type"],
+            workers=options["workers"],
+            force=options["force"],
+        )
+        nb_errors = 0
+        for (channel, channel_object), result in results.items():
+            target = "{} {}".format(channel or "-", channel_object or "-")
+            if isinstance(result, CircuitOpenError):
+                nb_errors += 1
+                self.stderr.write("{}: {}".format(target, result))
+            elif isinstance(result, Exception):
+                nb_errors += 1
+                self.stderr.write("{}: {!r}".format(target, result))
+            elif result == (False, False, False):
+                self.stdout.write("{}: not expired".format(target))
+            else:
+                self.stdout.write("{}: {} created, {} updated, {} deleted".format(target, *result))
+        if nb_errors:
+            raise CommandError("{} channel objects could not be refreshed".format(nb_errors))
@@ -0,0 +1,184 @@
+# Future imports
+from __future__ import annotations
+
+# Standard libs
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Any, Callable, Dict, FrozenSet, Iterator, Optional, TypeVar
+
+    from requests import Response
+
+    F = TypeVar("F", bound=Callable[..., Any])
+
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import inspect
+import json
+import logging
+import threading
+import time
+
+# Django imports
+from django.dispatch import Signal
+from django.utils.module_loading import import_string
+
+# DALEC imports
+from dalec import settings as app_settings
+
+__all__ = [
+    "Metrics",
+    "count_response",
+    "incr",
+    "measure",
+    "metrics_collected",
+    "timed",
+    "timer",
+]
+
+logger = logging.getLogger("dalec_caldav.metrics")
+
+# sent after each fetch of contents with kwargs: content_type, channel, channel_object, metrics
+metrics_collected = Signal()
+
+_current_metrics: ContextVar[Optional[Metrics]] = ContextVar("dalec_caldav_metrics", default=None)
+
+# phases being timed, to not count nested calls of the same phase twice
+_active_phases: ContextVar[FrozenSet[str]] = ContextVar(
+    "dalec_caldav_active_phases", default=frozenset()
+)
+
+
+class Metrics:
+    """
+    Cumulated timings (in seconds) of each phase of a fetch and counters (requests, bytes, events
+    parsed, cache hits…). Phases run in parallel threads are summed up, so their total can exceed
+    the "total" timing.
+    """
+
+    def __init__(self) -> None:
+        self.timings: Dict[str, float] = defaultdict(float)
+        self.counters: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add_timing(self, phase: str, duration: float) -> None:
+        with self._lock:
+            self.timings[phase] += duration
+
+    def incr(self, counter: str, value: int = 1) -> None:
+        with self._lock:
+            self.counters[counter] += value
+
+    def as_dict(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {"timings": dict(self.timings), "counters": dict(self.counters)}
+
+
+@contextmanager
+def timer(phase: str) -> Iterator[None]:
+    """
+    Add the time spent in the context to the phase of the current metrics (if any)
+    """
+    metrics = _current_metrics.get()
+    active_phases = _active_phases.get()
+    if metrics is None or phase in active_phases:
+        yield
+        return
+    token = _active_phases.set(active_phases | {phase})
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_timing(phase, time.perf_counter() - start)
+        _active_phases.reset(token)
+
+
+def timed(phase: str) -> Callable[[F], F]:
+    """
+    Decorator adding the time spent in the (sync or async) function to the phase of the current
+    metrics
+    """
+
+    def decorator(func: F) -> F:
+        if inspect.iscoroutinefunction(func):
+
+            @wraps(func)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                with timer(phase):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper  # type: ignore
+
+        @wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with timer(phase):
+                return func(*args, **kwargs)
+
+        return wrapper  # type: ignore
+
+    return decorator
+
+
+def incr(counter: str, value: int = 1) -> None:
+    """
+    Increment the counter of the current metrics (if any)
+    """
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.incr(counter, value)
+
+
+def count_response(response: Response, *args: Any, **kwargs: Any) -> None:
+    """
+    `requests` response hook counting requests and their bytes. Bytes of streamed responses are
+    only known from their Content-Length header.
+    """
+    metrics = _current_metrics.get()
+    if metrics is None:
+        return
+    body = response.request.body or b""
+    if kwargs.get("stream"):
+        received = int(response.headers.get("Content-Length", 0))
+    else:
+        received = len(response.content)
+    metrics.incr("requests")
+    metrics.incr("bytes_sent", len(body.encode() if isinstance(body, str) else body))
+    metrics.incr("bytes_received", received)
+
+
+@contextmanager
+def measure(
+    sender: Any, content_type: str, channel: Optional[str], channel_object: Optional[str]
+) -> Iterator[Metrics]:
+    """
+    Collect metrics of the code run in the context (threads started by `map_in_threads`
+    included), then publish them: send the `metrics_collected` signal, call the
+    `DALEC_CALDAV_METRICS_CALLBACK` and log them with `DALEC_CALDAV_METRICS_LOGGING`.
+    Nested measures are merged into the outer one.
+    """
+    if _current_metrics.get() is not None:
+        yield _current_metrics.get()  # type: ignore
+        return
+    metrics = Metrics()
+    token = _current_metrics.set(metrics)
+    try:
+        with timer("total"):
+            yield metrics
+    finally:
+        _current_metrics.reset(token)
+    kwargs = {
+        "content_type": content_type,
+        "channel": channel,
+        "channel_object": channel_object,
+        "metrics": metrics.as_dict(),
+    }
+    metrics_collected.send(sender=sender, **kwargs)
+    callback = app_settings.get_setting("CALDAV_METRICS_CALLBACK", None)
+    if callback:
+        if isinstance(callback, str):
+            callback = import_string(callback)
+        callback(**kwargs)
+    if app_settings.get_setting("CALDAV_METRICS_LOGGING", False):
+        logger.info(json.dumps(kwargs), extra={"dalec_caldav_metrics": kwargs})
@@ -0,0 +1,194 @@
+# Future imports
+from __future__ import annotations
+
+# Standard libs
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Any, Dict, Iterator, List, Optional, Tuple, Type
+    from vobject.behavior import Behavior
+
+import re
+
+# DALEC imports
+from vobject.base import getBehavior
+from vobject.base import ParseError
+from vobject.base import textLineToContentLine
+from vobject.icalendar import DateOrDateTimeBehavior
+from vobject.icalendar import Duration
+from vobject.icalendar import getTzid
+from vobject.icalendar import MultiTextBehavior
+from vobject.icalendar import stringToDate
+from vobject.icalendar import stringToDateTime
+from vobject.icalendar import stringToDurations
+from vobject.icalendar import stringToTextValues
+from vobject.icalendar import TextBehavior
+from vobject.icalendar import UTCDateTimeBehavior
+
+__all__ = ["parse_vevent", "parse_vevents", "UnsupportedData"]
+
+# unlike str.splitlines, only CR and LF end content lines (U+2028… are valid in values)
+_LINE_BREAK = re.compile(r"\r\n|\r|\n")
+
+
+class UnsupportedData(ValueError):
+    """
+    Raised when the fast parser can not handle some calendar data (ie: a TZID which is only
+    defined by the VTIMEZONE of the calendar). Callers should fallback to vobject.
+    """
+
+
+def parse_vevent(data: str) -> Dict[str, Any]:
+    """
+    Parse the first VEVENT of the given iCalendar data into a dict, without building the vobject
+    component tree. The result is the same as flattening `vobject.readOne(data).vevent`: keys are
+    lowercased property names, values are native values of the first occurrence of each property
+    and nested components (ie: VALARM) are parsed into nested dicts.
+
+    Properties which are not handled natively here (RDATE, TRIGGER, base64 encoded…) are
+    converted by vobject, one by one.
+    Raises UnsupportedData if data contains no VEVENT or can not be parsed without vobject.
+    """
+    for vevent in _iter_vevents(data):
+        # only the first VEVENT matters: no need to read further
+        return vevent
+    raise UnsupportedData("No VEVENT found")
+
+
+def parse_vevents(data: str) -> List[Dict[str, Any]]:
+    """
+    Same as `parse_vevent` but parse every VEVENT of the given iCalendar data (ie: a recurring
+    event with its overridden occurrences or occurrences expanded by the server).
+    """
+    vevents = list(_iter_vevents(data))
+    if not vevents:
+        raise UnsupportedData("No VEVENT found")
+    return vevents
+
+
+def _iter_vevents(data: str) -> Iterator[Dict[str, Any]]:
+    stack: List[Tuple[Dict[str, Any], Optional[Type[Behavior]]]] = []
+    skipped_depth = 0
+    for line in _unfold(data):
+        name, params, value = _split_line(line)
+        if name == "BEGIN":
+            component = value.strip().upper()
+            if skipped_depth or (not stack and component != "VEVENT"):
+                # VCALENDAR itself is not skipped: its children (VTIMEZONE, VEVENT…) are
+                skipped_depth += component != "VCALENDAR"
+                continue
+            content: Dict[str, Any] = {}
+            if stack:
+                stack[-1][0].setdefault(component.lower(), content)
+            stack.append((content, getBehavior(component)))
+        elif name == "END":
+            if skipped_depth:
+                skipped_depth -= 1
+            elif stack:
+                content, _ = stack.pop()
+                if not stack:
+                    yield content
+        elif stack:
+            content, behavior = stack[-1]
+            key = name.lower()
+            if key not in content:
+                content[key] = _to_native(behavior, name, params, value, line)
+
+
+def _unfold(data: str) -> Iterator[str]:
+    """
+    Iterate over logical lines (RFC 5545, 3.1: a CRLF followed by a whitespace is a folding)
+    """
+    current = None
+    for line in _LINE_BREAK.split(data):
+        if line[:1] in (" ", "\t"):
+            if current is not None:
+                current += line[1:]
+            continue
+        if current:
+            yield current
+        current = line
+    if current:
+        yield current
+
+
+def _split_line(line: str) -> Tuple[str, Dict[str, str], str]:
+    """
+    Split a content line into its uppercased name, its parameters and its raw value
+    """
+    head, sep, value = line.partition(":")
+    if '"' in head:
+        # a quoted parameter value can contain ":", find the first unquoted one
+        quoted = False
+        for index, char in enumerate(line):
+            if char == '"':
+                quoted = not quoted
+            elif char == ":" and not quoted:
+                head, value = line[:index], line[index:][1:]
+                break
+    elif not sep:
+        raise UnsupportedData("Invalid content line: {}".format(line))
+    name, *raw_params = head.split(";")
+    params = {}
+    for raw_param in raw_params:
+        param_name, _, param_value = raw_param.partition("=")
+        params[param_name.upper()] = param_value.strip('"')
+    return name.upper().replace("_", "-"), params, value
+
+
+def _to_native(
+    component_behavior: Optional[Type[Behavior]],
+    name: str,
+    params: Dict[str, str],
+    value: str,
+    line: str,
+) -> Any:
+    """
+    Convert a raw property value the same way vobject would do it as a child of a component
+    with the given behavior.
+    """
+    if component_behavior is None:
+        return value
+    if name in component_behavior.knownChildren:
+        behavior = getBehavior(name, component_behavior.knownChildren[name][2])
+    else:
+        behavior = component_behavior.defaultBehavior
+    if behavior is None:
+        return value
+    if value and "ENCODING" not in params:
+        if behavior is TextBehavior:
+            return stringToTextValues(value)[0]
+        if behavior is MultiTextBehavior:
+            return stringToTextValues(value)
+        if behavior is UTCDateTimeBehavior:
+            return _to_date_or_datetime(value, params, allow_date=False)
+        if behavior is DateOrDateTimeBehavior:
+            return _to_date_or_datetime(value, params, allow_date=True)
+        if behavior is Duration:
+            durations = stringToDurations(value)
+            if len(durations) == 1:
+                return durations[0]
+    return _to_native_with_vobject(behavior, line)
+
+
+def _to_date_or_datetime(value: str, params: Dict[str, str], allow_date: bool) -> Any:
+    tzinfo = None
+    if "TZID" in params:
+        tzinfo = getTzid(params["TZID"])
+        if tzinfo is None:
+            raise UnsupportedData("Unknown TZID {}".format(params["TZID"]))
+    if params.get("VALUE", "DATE-TIME").upper() == "DATE":
+        return stringToDate(value)
+    try:
+        return stringToDateTime(value, tzinfo)
+    except ParseError as e:
+        if allow_date:
+            return stringToDate(value)
+        raise UnsupportedData(str(e)) from e
+
+
+def _to_native_with_vobject(behavior: Type[Behavior], line: str) -> Any:
+    content_line = textLineToContentLine(line)
+    content_line.behavior = behavior
+    behavior.decode(content_line)
+    return content_line.transformToNative().value
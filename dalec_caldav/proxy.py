@@ -5,32 +5,138 @@ from __future__ import annotations
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
-    from datetime import date
-    from typing import Dict, Any, List
+    from typing import Dict, Any, Iterable, Iterator, List, Optional, Set, Tuple, Union
     from vobject.base import Component
-    from caldav.objects import Calendar, CalendarObjectResource
+    from caldav.davclient import DAVClient, DAVResponse
+    from caldav.objects import CalendarObjectResource
+    from django.db.models import Model
 
-from datetime import datetime, timedelta
+    from .aio import AsyncDAVClient
+
+import asyncio
+from contextvars import ContextVar
+from datetime import date, datetime, time, timedelta
+import hashlib
+import heapq
+import threading
+from itertools import islice
+from operator import itemgetter
+from datetime import timezone as dt_timezone
+from urllib.parse import quote
 from urllib.parse import urlparse
 
 # Django imports
-from django.conf import settings
-from django.utils.timezone import make_aware, now
+from django.db import connections
+from django.utils.timezone import get_current_timezone
+from django.utils.timezone import get_current_timezone_name, make_aware, make_naive, now
 
 
 # DALEC imports
-from caldav.davclient import DAVClient
+from caldav.elements import cdav
 from caldav.elements import dav
+from caldav.lib import error
+from caldav.lib.url import URL
+from caldav.objects import Calendar
+from caldav.objects import CalendarSet
 from caldav.objects import Event
 from dalec import settings as app_settings
 from dalec.proxy import Proxy
+from requests.exceptions import RequestException
+
+# Local Apps
+from .aio import aclients
+from .breaker import acquire_probe
+from .breaker import get_server
+from .breaker import is_open
+from .breaker import NETWORK_ERRORS
+from .breaker import record_failure
+from .breaker import record_success
+from .breaker import release_probe
+from .cache import call_once
+from .cache import contents_cache
+from .cache import get_cache
+from .cache import get_calendar_fields
+from .cache import get_calendar_infos
+from .cache import get_discovery
+from .cache import get_snapshot
+from .cache import invalidate_discovery
+from .cache import make_key
+from .cache import set_calendar_fields
+from .cache import set_calendar_infos
+from .cache import set_discovery
+from .cache import set_snapshot
+from .clients import clients
+from .dav import get_events_etags
+from .dav import get_events_from_response
+from .dav import iter_report
+from .dav import multiget_events
+from .elements import GetCTag
+from .metrics import incr
+from .metrics import measure
+from .metrics import timed
+from .parser import parse_vevent
+from .parser import parse_vevents
+from .parser import UnsupportedData
+from .scheduler import is_refresh_due
+from .scheduler import record_refresh
+from .utils import map_in_threads
+from .utils import SingleFlight
+
+# properties requested when listing calendars of the calendar home: the ones which would
+# require another PROPFIND per calendar later (ResourceType must stay the last one)
+CALENDARS_LISTING_PROPS = [dav.DisplayName(), GetCTag(), dav.SyncToken(), dav.ResourceType()]
+
+# number of events whose contents are populated (and normalized) at once
+CONTENTS_BATCH_SIZE = 500
+
+# fields of contents kept whatever `DALEC_CALDAV_CONTENT_PROPERTIES`: the ones needed by dalec
+# and the default templates, and the ones which are not iCalendar properties
+REQUIRED_CONTENT_FIELDS = frozenset(
+    [
+        "id",
+        "uid",
+        "recurrence-id",
+        "creation_dt",
+        "last_update_dt",
+        "dtstart",
+        "dtend",
+        "duration",
+        "start_date",
+        "start_time",
+        "end_date",
+        "end_time",
+        "event_url",
+        "dav_calendar_url",
+        "calendar_displayname",
+        "nextcloud_calendar_url",
+        "summary",
+        "location",
+        "description",
+    ]
+)
+
+# content type of the rows storing calendar-level fields of contents once per calendar (see
+# `DALEC_CALDAV_COMPACT_CALENDAR_FIELDS` setting)
+CALENDAR_FIELDS_CONTENT_TYPE = "calendar"
 
-client = DAVClient(
-    url=settings.DALEC_CALDAV_BASE_URL,
-    username=settings.DALEC_CALDAV_API_USERNAME,
-    password=settings.DALEC_CALDAV_API_PASSWORD,
+# contents fetched by `arefresh`, given to the synchronous `refresh`
+_prefetched_contents: ContextVar[Optional[Dict[str, dict]]] = ContextVar(
+    "dalec_caldav_prefetched_contents", default=None
 )
 
+# deleted ids and snapshot of contents, collected by `_fetch` for `refresh` in delta mode
+_delta: ContextVar[Optional[Dict[str, Any]]] = ContextVar("dalec_caldav_delta", default=None)
+
+# set while probing a server whose circuit is open (see `DALEC_CALDAV_CIRCUIT_BREAKER_THRESHOLD`)
+_probing: ContextVar[bool] = ContextVar("dalec_caldav_probing", default=False)
+
+# sync states of calendars and ids of contents of deleted events, collected by `_fetch` with
+# `DALEC_CALDAV_INCREMENTAL_SYNC`: they are only saved once contents are stored by `refresh`
+_sync: ContextVar[Optional[Dict[str, Any]]] = ContextVar("dalec_caldav_sync", default=None)
+
+# fetches in flight, shared by concurrent refreshes of the same channel object
+_fetches = SingleFlight()
+
 
 class CaldavProxy(Proxy):
     """
@@ -42,50 +148,882 @@ class CaldavProxy(Proxy):
     def _fetch(
         self, nb: int, content_type: str, channel: str, channel_object: str
     ) -> Dict[str, dict]:
+        contents = _prefetched_contents.get()
+        if contents is not None:
+            if app_settings.get_setting("CALDAV_ADAPTIVE_REFRESH", False):
+                record_refresh(content_type, channel, channel_object, contents)
+        elif content_type != "event":
+            raise ValueError(f"Invalid content_type {content_type}. Accepted: event.")
+        elif not app_settings.get_setting("CALDAV_COALESCE_REQUESTS", True):
+            contents = self._fetch_contents(nb, content_type, channel, channel_object)
+        else:
+            contents = self._fetch_coalesced(nb, content_type, channel, channel_object)
+        if app_settings.get_setting("CALDAV_COMPACT_CALENDAR_FIELDS", False):
+            contents = self._compact_calendar_fields(contents)
+        sync = _sync.get()
+        if sync is not None:
+            # an event may have been moved to another url (or calendar) of the channel object
+            sync["deleted"] = [
+                content_id for content_id in sync["deleted"] if content_id not in contents
+            ]
+        delta = _delta.get()
+        if delta is not None:
+            contents = self._get_delta(content_type, channel, channel_object, contents, delta)
+        return contents
+
+    def _fetch_coalesced(
+        self, nb: int, content_type: str, channel: str, channel_object: str
+    ) -> Dict[str, dict]:
+        """
+        Share the fetch of contents between concurrent callers (see
+        `DALEC_CALDAV_COALESCE_REQUESTS` setting)
+        """
+        key = make_key(
+            "fetch",
+            content_type,
+            channel,
+            channel_object,
+            str(nb),
+            repr(app_settings.get_setting("CALDAV_SERCH_EVENT_START_TIMEDELTA", None)),
+            repr(app_settings.get_setting("CALDAV_SERCH_EVENT_END_TIMEDELTA", None)),
+            repr(app_settings.get_setting("CALDAV_SEARCH_WINDOWS", None)),
+            # naive datetimes are made aware in the current timezone
+            get_current_timezone_name(),
+        )
+        contents = _fetches.do(
+            key, lambda: self._fetch_shared(key, nb, content_type, channel, channel_object)
+        )
+        # contents are shared by concurrent callers: each one gets its own dict to update
+        return dict(contents)
+
+    def _fetch_shared(
+        self, key: str, nb: int, content_type: str, channel: str, channel_object: str
+    ) -> Dict[str, dict]:
+        """
+        With `DALEC_CALDAV_COALESCE_ACROSS_PROCESSES`, contents are fetched by only one process
+        at a time and shared with the other ones through the cache.
+        """
+        if app_settings.get_setting("CALDAV_COALESCE_ACROSS_PROCESSES", False):
+            return call_once(
+                key,
+                lambda: self._fetch_contents(nb, content_type, channel, channel_object),
+                app_settings.get_setting("CALDAV_COALESCE_TIMEOUT", 30),
+            )
+        return self._fetch_contents(nb, content_type, channel, channel_object)
+
+    def _fetch_contents(
+        self, nb: int, content_type: str, channel: str, channel_object: str
+    ) -> Dict[str, dict]:
+        # failures are counted once per fetch, not per (coalesced) caller
+        server = get_server(channel, channel_object)
+        try:
+            with measure(self.__class__, content_type, channel, channel_object):
+                contents = self._fetch_event(nb, channel, channel_object)
+        except NETWORK_ERRORS:
+            record_failure(server)
+            raise
+        record_success(server)
+        if app_settings.get_setting("CALDAV_ADAPTIVE_REFRESH", False):
+            record_refresh(content_type, channel, channel_object, contents)
+        return contents
+
+    def refresh(
+        self,
+        content_type: str,
+        channel: Optional[str] = None,
+        channel_object: Optional[str] = None,
+        force: Optional[bool] = False,
+        dj_channel_obj: Optional[Model] = None,
+    ) -> Union[Tuple[int, int, int], Tuple[bool, bool, bool]]:
+        """
+        Same as `Proxy.refresh` but, with `DALEC_CALDAV_ADAPTIVE_REFRESH`, calendars are only
+        refreshed when the interval learned from their previous refreshes elapsed.
+        With `DALEC_CALDAV_DELTA`, only created or modified contents are given to dalec and
+        contents of events which are not returned by the CalDav server anymore are deleted.
+        With `DALEC_CALDAV_INCREMENTAL_SYNC`, contents of events deleted from the CalDav server
+        are deleted and sync states of calendars are only saved once contents are stored.
+        While the circuit of an unreachable server is open, nothing is refreshed (stored contents
+        are kept) and the server is probed in the background once its backoff delay elapsed.
+        """
+        server = get_server(channel, channel_object)
+        if not _probing.get() and is_open(server):
+            if acquire_probe(server):
+                self._start_probe(server, content_type, channel, channel_object, dj_channel_obj)
+            return False, False, False
+        return self._refresh(content_type, channel, channel_object, force, dj_channel_obj)
+
+    def _refresh(
+        self,
+        content_type: str,
+        channel: Optional[str],
+        channel_object: Optional[str],
+        force: Optional[bool],
+        dj_channel_obj: Optional[Model],
+    ) -> Union[Tuple[int, int, int], Tuple[bool, bool, bool]]:
+        adaptive = app_settings.get_setting("CALDAV_ADAPTIVE_REFRESH", False)
+        if adaptive and not force and not is_refresh_due(content_type, channel, channel_object):
+            return False, False, False
+        incremental = app_settings.get_setting("CALDAV_INCREMENTAL_SYNC", False)
+        delta_mode = app_settings.get_setting("CALDAV_DELTA", False)
+        if not incremental and not delta_mode:
+            return super().refresh(content_type, channel, channel_object, force, dj_channel_obj)
+        delta: Optional[Dict[str, Any]] = None
+        if delta_mode:
+            delta = {"deleted": [], "snapshot": None}
+        # `arefresh` collects sync states while fetching contents, before calling `refresh`
+        sync = _sync.get()
+        sync_token = None
+        if incremental and sync is None:
+            sync = {"states": {}, "deleted": []}
+            sync_token = _sync.set(sync)
+        delta_token = _delta.set(delta)
+        try:
+            result = super().refresh(content_type, channel, channel_object, force, dj_channel_obj)
+        finally:
+            _delta.reset(delta_token)
+            if sync_token is not None:
+                _sync.reset(sync_token)
+        deleted = set(delta["deleted"] if delta is not None else [])
+        if sync is not None:
+            deleted.update(sync["deleted"])
+        nb_deleted = 0
+        if deleted:
+            nb_deleted, _ = (
+                self.get_contents_queryset(content_type, channel, channel_object)  # type: ignore
+                .filter(content_id__in=deleted)
+                .delete()
+            )
+        # contents are stored: the next refresh can rely on these sync states and snapshot
+        if sync is not None:
+            cache = get_cache()
+            for sync_key, state in sync["states"].items():
+                cache.set(sync_key, state, None)
+        if delta is not None and delta["snapshot"] is not None:
+            snapshot = {
+                content_id: fingerprint
+                for content_id, fingerprint in delta["snapshot"].items()
+                if content_id not in deleted
+            }
+            set_snapshot(content_type, channel, channel_object, snapshot)
+        if not nb_deleted:
+            return result
+        nb_created, nb_updated, nb_exterminated = result
+        return nb_created, nb_updated, nb_exterminated + nb_deleted
+
+    def _start_probe(
+        self,
+        server: str,
+        content_type: str,
+        channel: Optional[str],
+        channel_object: Optional[str],
+        dj_channel_obj: Optional[Model],
+    ) -> None:
+        """
+        Refresh the channel object in a background thread to check if the server is reachable
+        again: the circuit is closed on success, its backoff delay is doubled on failure.
+        """
+
+        def probe() -> None:
+            token = _probing.set(True)
+            try:
+                self.refresh(content_type, channel, channel_object, True, dj_channel_obj)
+            except NETWORK_ERRORS:
+                # already counted by `_fetch_contents`: the backoff delay is doubled
+                pass
+            except (RequestException, error.DAVError):
+                # the server answers but still fails (ie: 5xx): the circuit stays open
+                record_failure(server)
+            finally:
+                _probing.reset(token)
+                release_probe(server)
+                # database connections are opened per thread
+                connections.close_all()
+
+        threading.Thread(target=probe, name="dalec_caldav_probe", daemon=True).start()
+
+    def _get_delta(
+        self,
+        content_type: str,
+        channel: str,
+        channel_object: str,
+        contents: Dict[str, dict],
+        delta: Dict[str, Any],
+    ) -> Dict[str, dict]:
+        """
+        Return only contents which were created or modified since the previous refresh
+        (compared to a snapshot of fingerprints of stored contents). Ids of contents which are
+        not returned by the CalDav server anymore are added to `delta["deleted"]` and the new
+        snapshot is set to `delta["snapshot"]`.
+        """
+        previous_snapshot = get_snapshot(content_type, channel, channel_object) or {}
+        if previous_snapshot:
+            # contents may have left the database since the snapshot (purge, dalec's
+            # exterminate…): they must be given to dalec again
+            stored_contents = self.get_contents_queryset(  # type: ignore
+                content_type, channel, channel_object
+            )
+            stored_ids = set(stored_contents.values_list("content_id", flat=True))
+            previous_snapshot = {
+                content_id: fingerprint
+                for content_id, fingerprint in previous_snapshot.items()
+                if content_id in stored_ids
+            }
+        snapshot = {
+            content_id: hashlib.md5(repr(content).encode("utf-8")).hexdigest()
+            for content_id, content in contents.items()
+        }
+        if app_settings.get_setting("CALDAV_INCREMENTAL_SYNC", False):
+            # only changed events were fetched: deleted ones are reported by the sync (see
+            # `_get_changed_events`)
+            snapshot = {**previous_snapshot, **snapshot}
+        else:
+            delta["deleted"] = [
+                content_id for content_id in previous_snapshot if content_id not in snapshot
+            ]
+        delta["snapshot"] = snapshot
+        return {
+            content_id: content
+            for content_id, content in contents.items()
+            if previous_snapshot.get(content_id) != snapshot[content_id]
+        }
+
+    async def arefresh(
+        self,
+        content_type: str,
+        channel: Optional[str] = None,
+        channel_object: Optional[str] = None,
+        force: Optional[bool] = False,
+        dj_channel_obj: Optional[Model] = None,
+    ) -> Union[Tuple[int, int, int], Tuple[bool, bool, bool]]:
+        """
+        Asynchronous version of `refresh`: contents are fetched on the event loop, only
+        database queries are run in a thread.
+        """
+        # asgiref is only a dependency of django>=3.0
+        from asgiref.sync import sync_to_async
+
+        if not force:
+            if app_settings.get_setting("CALDAV_ADAPTIVE_REFRESH", False) and not is_refresh_due(
+                content_type, channel, channel_object
+            ):
+                return False, False, False
+            last_fetch = await sync_to_async(self.get_last_fetch)(
+                content_type, channel, channel_object
+            )
+            too_old = now() - timedelta(seconds=app_settings.TTL)
+            if last_fetch and last_fetch.last_fetch_dt > too_old:
+                return False, False, False
+        server = get_server(channel, channel_object)
+        if is_open(server):
+            # `refresh` starts a probe of the server if needed
+            return await sync_to_async(self.refresh)(
+                content_type, channel, channel_object, force, dj_channel_obj
+            )
+        nb = app_settings.get_for("NB_CONTENTS_KEPT", self.app, content_type)
+        sync_token = None
+        if app_settings.get_setting("CALDAV_INCREMENTAL_SYNC", False):
+            # sync states collected while fetching contents are saved by `refresh`
+            sync_token = _sync.set({"states": {}, "deleted": []})
+        try:
+            contents = await self._afetch_contents(nb, content_type, channel, channel_object)
+            token = _prefetched_contents.set(contents)
+            try:
+                return await sync_to_async(self.refresh)(
+                    content_type, channel, channel_object, True, dj_channel_obj
+                )
+            finally:
+                _prefetched_contents.reset(token)
+        finally:
+            if sync_token is not None:
+                _sync.reset(sync_token)
+
+    async def _afetch_contents(
+        self,
+        nb: int,
+        content_type: str,
+        channel: Optional[str],
+        channel_object: Optional[str],
+    ) -> Dict[str, dict]:
+        """
+        Asynchronous version of `_fetch_contents`
+        """
+        server = get_server(channel, channel_object)
+        try:
+            # connections are closed once fetched: the event loop may not outlive this refresh
+            # (ie: with `async_to_sync`)
+            async with aclients.scope():
+                with measure(self.__class__, content_type, channel, channel_object):
+                    contents = await self._afetch(
+                        nb, content_type, channel, channel_object  # type: ignore
+                    )
+        except NETWORK_ERRORS:
+            record_failure(server)
+            raise
+        record_success(server)
+        return contents
+
+    async def _afetch(
+        self, nb: int, content_type: str, channel: str, channel_object: str
+    ) -> Dict[str, dict]:
+        """
+        Asynchronous version of `_fetch` (requires httpx)
+        """
         if content_type == "event":
-            return self._fetch_event(nb, channel, channel_object)
+            return await self._afetch_event(nb, channel, channel_object)
         raise ValueError(f"Invalid content_type {content_type}. Accepted: event.")
 
+    async def _afetch_event(self, nb: int, channel: str, channel_object: str) -> Dict[str, dict]:
+        """
+        Asynchronous version of `_fetch_event`: requests of every calendar are sent concurrently
+        on the event loop. Incremental sync and `DALEC_CALDAV_LIMIT_TO_NB` rely on the
+        synchronous client: with them, `_fetch_event` is run in a thread.
+        """
+        from asgiref.sync import sync_to_async
+
+        if app_settings.get_setting("CALDAV_INCREMENTAL_SYNC", False) or app_settings.get_setting(
+            "CALDAV_LIMIT_TO_NB", False
+        ):
+            # it may query the database (see `_get_changed_events`): run it in the thread
+            # shared by database queries
+            return await sync_to_async(self._fetch_event)(nb, channel, channel_object)
+        if channel == "url" and channel_object:
+            if channel_object[-1] != "/":
+                channel_object += "/"
+            client = aclients.get_client_for_url(channel_object)
+            calendar = Calendar(url=client.url.join(channel_object))
+            return await self._afetch_calendars_events(client, [calendar])
+
+        client = aclients.get_client()
+        try:
+            calendars = await self._aget_principal_calendars(client)
+            return await self._afetch_calendars_events(client, calendars)
+        except error.NotFoundError:
+            # cached calendars may have been deleted or moved since they were discovered
+            invalidate_discovery(str(client.url), client.username)
+            calendars = await self._aget_principal_calendars(client, use_cache=False)
+            return await self._afetch_calendars_events(client, calendars)
+
+    async def _afetch_calendars_events(
+        self, client: AsyncDAVClient, calendars: List[Calendar]
+    ) -> Dict[str, dict]:
+        async def fetch_calendar(calendar: Calendar) -> List[dict]:
+            start, end = self._get_search_window(str(calendar.url))
+            # like with `_fetch_calendars_events`, infos are only needed if there are events
+            # (and caldav normalizes `calendar.url` while reading the search response)
+            events = await self._aget_events(client, calendar, start, end)
+            if not events:
+                return []
+            calendar_infos = await self._aget_calendar_infos(client, calendar)
+            return self._populate_calendar_contents(events, calendar_infos)
+
+        contents = {}
+        # results are merged in calendars order to keep the output deterministic
+        for calendar_contents in await asyncio.gather(*map(fetch_calendar, calendars)):
+            for content in calendar_contents:
+                contents[content["id"]] = content
+        return contents
+
+    @timed("discovery")
+    async def _aget_principal_calendars(
+        self, client: AsyncDAVClient, use_cache: bool = True
+    ) -> List[Calendar]:
+        """
+        Asynchronous version of `_get_principal_calendars`
+        """
+        discovery = get_discovery(str(client.url), client.username) if use_cache else None
+        incr("discovery_cache_misses" if discovery is None else "discovery_cache_hits")
+        if discovery is not None:
+            calendar_home = CalendarSet(url=discovery["calendar_home"])
+            return self._get_discovered_calendars(calendar_home, discovery)
+        calendar_home = CalendarSet(url=await client.get_calendar_home_url())
+        response = await client.propfind(calendar_home.url, CALENDARS_LISTING_PROPS, depth=1)
+        calendars = self._get_listed_calendars(calendar_home, response)
+        set_discovery(
+            str(client.url), client.username, self._make_discovery(calendar_home, calendars)
+        )
+        return calendars
+
+    @timed("report")
+    async def _aget_events(
+        self,
+        client: AsyncDAVClient,
+        calendar: Calendar,
+        start: Optional[datetime],
+        end: Optional[datetime],
+    ) -> List[Event]:
+        """
+        Asynchronous version of `_get_events`
+        """
+        expand = app_settings.get_setting("CALDAV_EXPAND_RECURRENCES", False) and start and end
+        xml, _ = calendar.build_search_xml_query(
+            comp_class=Event, start=start, end=end, expand=expand, props=[dav.GetEtag()]
+        )
+        response = await client.report(calendar.url, xml)
+        return get_events_from_response(calendar, response)
+
+    @timed("calendar_infos")
+    async def _aget_calendar_infos(
+        self, client: AsyncDAVClient, calendar: Calendar
+    ) -> Dict[str, Any]:
+        """
+        Asynchronous version of `_get_calendar_infos`
+        """
+        if (
+            get_calendar_infos(str(calendar.url)) is None
+            and dav.DisplayName.tag not in calendar.props
+        ):
+            calendar.props[dav.DisplayName.tag] = await client.get_property(
+                calendar.url, dav.DisplayName()
+            )
+        return self._get_calendar_infos(calendar)
+
     def _fetch_event(self, nb: int, channel: str, channel_object: str) -> Dict[str, dict]:
         """
         Get latest events from calendar(s)
         """
+        incremental = app_settings.get_setting("CALDAV_INCREMENTAL_SYNC", False)
+        # without any stored content (first fetch or purged contents), previous sync states
+        # are meaningless: every event must be fetched again.
+        reset = (
+            incremental
+            and not self.get_contents_queryset("event", channel, channel_object).exists()
+        )
 
         if channel == "url" and channel_object:
             if channel_object[-1] != "/":
                 channel_object += "/"
-            calendars = client.calendar(url=channel_object)
+            calendars = clients.get_client_for_url(channel_object).calendar(url=channel_object)
             if type(calendars) != list:
                 calendars = [calendars]
-        else:
-            principal = client.principal()
-            calendars = principal.calendars()
+            return self._fetch_calendars_events(nb, calendars, channel, channel_object, reset)
+
+        client = clients.get_client()
+        try:
+            calendars = self._get_principal_calendars(client, with_sync_properties=incremental)
+            return self._fetch_calendars_events(nb, calendars, channel, channel_object, reset)
+        except error.NotFoundError:
+            # cached calendars may have been deleted or moved since they were discovered
+            invalidate_discovery(str(client.url), client.username)
+            calendars = self._get_principal_calendars(
+                client, with_sync_properties=incremental, use_cache=False
+            )
+            return self._fetch_calendars_events(nb, calendars, channel, channel_object, reset)
+
+    def _fetch_calendars_events(
+        self,
+        nb: int,
+        calendars: List[Calendar],
+        channel: str,
+        channel_object: str,
+        reset: bool,
+    ) -> Dict[str, dict]:
+        incremental = app_settings.get_setting("CALDAV_INCREMENTAL_SYNC", False)
+        workers = app_settings.get_setting("CALDAV_CONCURRENT_WORKERS", 1)
+        # incremental sync already fetches only changed events
+        limited = not incremental and app_settings.get_setting("CALDAV_LIMIT_TO_NB", False)
+        if limited:
+            selected_urls = self._select_latest_events(nb, calendars, workers)
+
+        streaming = app_settings.get_setting("CALDAV_STREAMING", False)
+
+        def fetch_calendar(calendar: Calendar) -> List[dict]:
+            calendar = self._get_thread_calendar(calendar)
+            events: Iterable[Event]
+            if incremental:
+                sync_key = make_key("sync", channel, channel_object, str(calendar.url))
+                events, sync_state, removed = self._get_changed_events(
+                    calendar, sync_key, reset=reset
+                )
+            elif limited:
+                urls = selected_urls.get(str(calendar.url))
+                events = self._multiget_events(calendar, urls) if urls else []
+            elif streaming:
+                events = self._iter_events(calendar)
+            else:
+                events = self._get_events(calendar)
+            contents: List[dict] = []
+            calendar_infos = None
+            events = iter(events)
+            # contents are populated by batches, without loading every streamed event at once
+            for batch in iter(lambda: list(islice(events, CONTENTS_BATCH_SIZE)), []):
+                # infos are only needed if there are events
+                if calendar_infos is None:
+                    calendar_infos = self._get_calendar_infos(calendar)
+                contents += self._populate_calendar_contents(batch, calendar_infos)
+            if incremental:
+                self._record_sync_state(sync_key, sync_state, removed, contents)
+            return contents
 
         contents = {}
-        for calendar in calendars:
-            calendar_infos = self._get_calendar_infos(calendar)
-            for event in self._get_events(calendar):
-                content = self._populate_content(event, calendar_infos)
+        # results are merged in calendars order to keep the output deterministic
+        for calendar_contents in map_in_threads(fetch_calendar, calendars, workers):
+            for content in calendar_contents:
                 contents[content["id"]] = content
         return contents
 
-    def _get_events(self, calendar: Calendar) -> List[CalendarObjectResource]:
+    def _get_thread_calendar(self, calendar: Calendar) -> Calendar:
+        """
+        Return the calendar bound to the client of the current thread: calendars are discovered
+        by the caller's thread but fetched by `map_in_threads` workers, and clients (and their
+        HTTP session) must not be shared between threads.
+        """
+        client = clients.get_thread_client(calendar.client)
+        if client is calendar.client:
+            return calendar
+        return Calendar(
+            client=client,
+            url=calendar.url,
+            parent=calendar.parent,
+            name=calendar.name,
+            id=calendar.id,
+            props=calendar.props,
+        )
+
+    @timed("report")
+    def _select_latest_events(
+        self, nb: int, calendars: List[Calendar], workers: int
+    ) -> Dict[str, List[URL]]:
+        """
+        Select the `nb` last modified events of the search window among all calendars (dalec
+        keeps only them anyway) without downloading their calendar data.
+        Returns urls of selected events by calendar url.
+        """
+        etags_by_calendar = map_in_threads(
+            lambda calendar: get_events_etags(
+                self._get_thread_calendar(calendar), *self._get_search_window(str(calendar.url))
+            ),
+            calendars,
+            workers,
+        )
+        candidates = (
+            (last_modified or 0, url, str(calendar.url))
+            for calendar, etags in zip(calendars, etags_by_calendar)
+            for url, _, last_modified in etags
+        )
+        selected_urls: Dict[str, List[URL]] = {}
+        for _, url, calendar_url in heapq.nlargest(nb, candidates, key=itemgetter(0)):
+            selected_urls.setdefault(calendar_url, []).append(url)
+        return selected_urls
+
+    @timed("discovery")
+    def _get_principal_calendars(
+        self, client: DAVClient, with_sync_properties: bool, use_cache: bool = True
+    ) -> List[Calendar]:
+        """
+        Same as `client.principal().calendars()` but the calendar home and calendars are cached
+        between refreshes (see `DALEC_CALDAV_DISCOVERY_TTL` setting).
+
+        With `with_sync_properties`, calendars are always listed again to fetch, in the same
+        Depth:1 PROPFIND, the properties which would require another PROPFIND per calendar
+        later (ctag, sync-token).
+        """
+        discovery = get_discovery(str(client.url), client.username) if use_cache else None
+        incr("discovery_cache_misses" if discovery is None else "discovery_cache_hits")
+        if discovery is None:
+            calendar_home = client.principal().calendar_home_set
+        else:
+            calendar_home = CalendarSet(client=client, url=discovery["calendar_home"])
+            if not with_sync_properties:
+                return self._get_discovered_calendars(calendar_home, discovery)
+
+        response = calendar_home._query_properties(CALENDARS_LISTING_PROPS, depth=1)
+        calendars = self._get_listed_calendars(calendar_home, response)
+        if discovery is None:
+            set_discovery(
+                str(client.url), client.username, self._make_discovery(calendar_home, calendars)
+            )
+        return calendars
+
+    def _get_discovered_calendars(
+        self, calendar_home: CalendarSet, discovery: Dict[str, Any]
+    ) -> List[Calendar]:
+        return [
+            Calendar(
+                client=calendar_home.client,
+                url=calendar["url"],
+                parent=calendar_home,
+                name=calendar["name"],
+                props={dav.DisplayName.tag: calendar["name"]},
+            )
+            for calendar in discovery["calendars"]
+        ]
+
+    def _get_listed_calendars(
+        self, calendar_home: CalendarSet, response: DAVResponse
+    ) -> List[Calendar]:
+        """
+        Build calendars from the response of a Depth:1 PROPFIND of `CALENDARS_LISTING_PROPS` on
+        the calendar home
+        """
+        properties = response.expand_simple_props(
+            props=CALENDARS_LISTING_PROPS[:-1], multi_value_props=[dav.ResourceType()]
+        )
+        calendars = []
+        for path, calendar_props in properties.items():
+            if cdav.Calendar.tag not in calendar_props.pop(dav.ResourceType.tag):
+                continue
+            if URL(path).hostname is None:
+                path = quote(path)
+            calendars.append(
+                Calendar(
+                    client=calendar_home.client,
+                    url=calendar_home.url.join(path),
+                    parent=calendar_home,
+                    name=calendar_props[dav.DisplayName.tag],
+                    props=calendar_props,
+                )
+            )
+        return calendars
+
+    def _make_discovery(
+        self, calendar_home: CalendarSet, calendars: List[Calendar]
+    ) -> Dict[str, Any]:
+        return {
+            "calendar_home": str(calendar_home.url),
+            "calendars": [
+                {"url": str(calendar.url), "name": calendar.name} for calendar in calendars
+            ],
+        }
+
+    def _get_search_window(
+        self, calendar_url: Optional[str] = None
+    ) -> Tuple[Optional[datetime], Optional[datetime]]:
+        """
+        Return the (start, end) datetimes of events to search. Both are relative to now and
+        can be defined per calendar with the `DALEC_CALDAV_SEARCH_WINDOWS` setting.
+        """
         start_td = app_settings.get_setting(
             "CALDAV_SERCH_EVENT_START_TIMEDELTA", timedelta(days=-1)
         )
         end_td = app_settings.get_setting("CALDAV_SERCH_EVENT_END_TIMEDELTA", timedelta(days=365))
+        windows = app_settings.get_setting("CALDAV_SEARCH_WINDOWS", {})
+        if calendar_url and windows:
+            # compare canonical urls (explicit port, no "//"…) like caldav does
+            canonical_url = str(URL.objectify(calendar_url).canonical())
+            prefixes = [
+                prefix
+                for prefix in windows
+                if canonical_url.startswith(str(URL.objectify(prefix).canonical()))
+            ]
+        else:
+            prefixes = []
+        if prefixes:
+            window = windows[max(prefixes, key=len)]
+            start_td = window.get("start", start_td)
+            end_td = window.get("end", end_td)
+        current_dt = now()
+        return (
+            current_dt + start_td if start_td is not None else None,
+            current_dt + end_td if end_td is not None else None,
+        )
+
+    @timed("report")
+    def _get_events(
+        self,
+        calendar: Calendar,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> List[CalendarObjectResource]:
+        if start is None and end is None:
+            start, end = self._get_search_window(str(calendar.url))
+        if app_settings.get_setting("CALDAV_EXPAND_RECURRENCES", False) and start and end:
+            # ask the server to return one VEVENT per occurrence. The XML query is built here
+            # to prevent caldav from expanding events client side (unbounded) when the server
+            # ignores the expand element: `_populate_contents` takes care of it.
+            xml, _ = calendar.build_search_xml_query(
+                comp_class=Event, start=start, end=end, expand=True, props=[dav.GetEtag()]
+            )
+            return calendar.search(xml=xml, comp_class=Event, props=[dav.GetEtag()])
         search_kwargs = {
             "comp_class": Event,
-            "start": now() + start_td if start_td is not None else None,
-            "end": now() + end_td if end_td is not None else None,
+            "start": start,
+            "end": end,
+            # etags allow to reuse contents of unchanged events
+            "props": [dav.GetEtag()],
         }
         return calendar.search(**search_kwargs)
 
+    def _iter_events(
+        self,
+        calendar: Calendar,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> Iterator[Event]:
+        """
+        Same as `_get_events` but the search response is parsed while it is downloaded and
+        events are built one at a time (see `DALEC_CALDAV_STREAMING` setting).
+        """
+        if start is None and end is None:
+            start, end = self._get_search_window(str(calendar.url))
+        expand = app_settings.get_setting("CALDAV_EXPAND_RECURRENCES", False) and start and end
+        xml, _ = calendar.build_search_xml_query(
+            comp_class=Event, start=start, end=end, expand=expand, props=[dav.GetEtag()]
+        )
+        missing_urls = []
+        for url, etag, data in iter_report(calendar, xml):
+            if data:
+                yield Event(
+                    calendar.client,
+                    url=url,
+                    data=data,
+                    parent=calendar,
+                    props={dav.GetEtag.tag: etag},
+                )
+            else:
+                # some servers do not return calendar data of matching events
+                missing_urls.append(url)
+        if missing_urls:
+            yield from self._multiget_events(calendar, missing_urls)
+
+    @timed("report")
+    def _get_changed_events(
+        self, calendar: Calendar, sync_key: str, reset: bool = False
+    ) -> Tuple[List[CalendarObjectResource], Dict[str, Any], List[str]]:
+        """
+        Get events of the calendar which changed since its last sync, relying on the calendar's
+        ctag and sync-token (RFC 6578).
+        If the calendar did not change, no event is fetched at all. If the server does not
+        expose a ctag nor a sync-token, every event is fetched (like without incremental sync).
+        Returns changed events, the new sync state of the calendar (see `_record_sync_state`)
+        and urls of events which were removed since the last sync.
+        """
+        start, end = self._get_search_window(str(calendar.url))
+        state = None if reset else get_cache().get(sync_key)
+        if GetCTag.tag in calendar.props and dav.SyncToken.tag in calendar.props:
+            # already fetched while listing calendars
+            props = calendar.props
+        else:
+            props = calendar.get_properties([dav.DisplayName(), GetCTag(), dav.SyncToken()])
+        ctag = props.get(GetCTag.tag)
+        sync_token = props.get(dav.SyncToken.tag)
+        # ids of contents by event url (states saved before they were tracked have none)
+        hrefs: Dict[str, List[str]] = dict(state.get("hrefs", {})) if state else {}
+        removed: List[str] = []
+        if state is None or (ctag is None and sync_token is None):
+            events = self._get_events(calendar, start, end)
+            # every event was fetched: the ones which were not are removed
+            removed = list(hrefs)
+        else:
+            events = []
+            if (ctag, sync_token) != (state["ctag"], state["sync_token"]):
+                synced = None
+                if state["sync_token"] and sync_token:
+                    synced = self._get_synced_events(calendar, state["sync_token"], start, end)
+                if synced is None:
+                    events = self._get_events(calendar, start, end)
+                    removed = list(hrefs)
+                else:
+                    events, removed = synced
+            if state["end"] is not None and (end is None or end > state["end"]):
+                # the search window moved since the last sync: unchanged events may have
+                # entered into it.
+                events += self._get_events(calendar, state["end"], end)
+        new_state = {"ctag": ctag, "sync_token": sync_token, "end": end, "hrefs": hrefs}
+        return events, new_state, removed
+
+    def _record_sync_state(
+        self, sync_key: str, state: Dict[str, Any], removed: List[str], contents: List[dict]
+    ) -> None:
+        """
+        Update ids of contents by event url of the new sync state of a calendar with its fetched
+        contents, and collect ids of contents of removed events. `refresh` saves the state and
+        deletes these contents once fetched contents are stored: a fetch whose contents are not
+        stored (ie: a direct `_fetch` call or a failed refresh) does not move the sync forward.
+        """
+        sync = _sync.get()
+        if sync is None:
+            return
+        hrefs = state["hrefs"]
+        deleted: List[str] = []
+        for url in removed:
+            deleted += hrefs.pop(url, [])
+        fetched: Dict[str, List[str]] = {}
+        for content in contents:
+            fetched.setdefault(content["event_url"], []).append(content["id"])
+        for url, content_ids in fetched.items():
+            # ie: occurrences which are not in the search window anymore
+            deleted += hrefs.get(url, [])
+            hrefs[url] = content_ids
+        fetched_ids = {content["id"] for content in contents}
+        sync["deleted"].extend(
+            content_id for content_id in deleted if content_id not in fetched_ids
+        )
+        sync["states"][sync_key] = state
+
+    def _get_synced_events(
+        self,
+        calendar: Calendar,
+        sync_token: str,
+        start: Optional[datetime],
+        end: Optional[datetime],
+    ) -> Optional[Tuple[List[CalendarObjectResource], List[str]]]:
+        """
+        Get events added or modified since the given sync-token through a sync-collection
+        REPORT and fetch them with a calendar-multiget REPORT. Urls of deleted events and of
+        modified events which left the search window are returned with them.
+        Returns None if the server refused the sync-token.
+        """
+        try:
+            changes = calendar.objects_by_sync_token(sync_token=sync_token)
+        except error.DAVError:
+            return None
+        # deleted resources are returned without etag
+        removed = [obj.canonical_url for obj in changes if obj.props.get(dav.GetEtag.tag) is None]
+        urls = [obj.url for obj in changes if obj.props.get(dav.GetEtag.tag) is not None]
+        if not urls:
+            return [], removed
+        events = []
+        for event in self._multiget_events(calendar, urls):
+            if self._is_in_search_window(self._parse_event(event), start, end):
+                events.append(event)
+            else:
+                removed.append(event.canonical_url)
+        return events, removed
+
+    @timed("report")
+    def _multiget_events(self, calendar: Calendar, urls: List[URL]) -> List[Event]:
+        """
+        Fetch the given events in batches of `DALEC_CALDAV_MULTIGET_CHUNK_SIZE`
+        """
+        chunk_size = app_settings.get_setting("CALDAV_MULTIGET_CHUNK_SIZE", 100)
+        return multiget_events(calendar, urls, chunk_size)
+
+    def _is_in_search_window(
+        self, vevent: Dict[str, Any], start: Optional[datetime], end: Optional[datetime]
+    ) -> bool:
+        """
+        Client side equivalent of the time-range filter used by `_get_events`.
+        Recurring events are kept as soon as they start before the end of the window.
+        """
+        dtstart = self._as_aware_datetime(vevent["dtstart"])
+        if "dtend" in vevent:
+            dtend = self._as_aware_datetime(vevent["dtend"])
+        elif "duration" in vevent:
+            dtend = dtstart + vevent["duration"]
+        else:
+            dtend = dtstart
+        if end is not None and dtstart > end:
+            return False
+        recurring = "rrule" in vevent or "rdate" in vevent
+        if start is not None and not recurring and dtend < start:
+            return False
+        return True
+
+    def _as_aware_datetime(self, value: date) -> datetime:
+        if not isinstance(value, datetime):
+            value = datetime.combine(value, time.min)
+        return make_aware(value) if not value.tzinfo else value
+
+    @timed("calendar_infos")
     def _get_calendar_infos(self, calendar: Calendar) -> Dict[str, Any]:
         url = str(calendar.url)
+        infos = get_calendar_infos(url)
+        incr("calendar_infos_cache_misses" if infos is None else "calendar_infos_cache_hits")
+        if infos is not None:
+            return infos
         infos = {
             "type": "default",
-            "display_name": calendar.get_property(dav.DisplayName()),
+            "display_name": calendar.get_property(dav.DisplayName(), use_cached=True),
             "url": url,
         }
         if "/remote.php/dav/public-calendars/" in url:
@@ -101,8 +1039,88 @@ class CaldavProxy(Proxy):
                     "token": token,
                 }
             )
+        set_calendar_infos(url, infos)
         return infos
 
+    def get_calendar_fields(self, content: dict) -> Dict[str, Any]:
+        """
+        Return calendar-level fields of a content: `url`, `display_name` and, for nextcloud
+        public calendars, `nextcloud_calendar_url`. With `DALEC_CALDAV_COMPACT_CALENDAR_FIELDS`
+        they are not stored in each content but once per calendar, by each refresh. This is
+        called while templates are rendered: it never queries the CalDav server, if the
+        calendar was not refreshed yet only `url` is returned.
+        """
+        url = content["dav_calendar_url"]
+        if "calendar_displayname" in content:
+            return self._get_content_calendar_fields(content)
+        fields = get_calendar_fields(url)
+        if fields is not None:
+            return fields
+        # evicted from the cache (or cached by another process)
+        fields = (
+            self.get_contents_queryset(CALENDAR_FIELDS_CONTENT_TYPE, "url", url)  # type: ignore
+            .values_list("content_data", flat=True)
+            .first()
+        )
+        if fields is None:
+            return {"url": url}
+        set_calendar_fields(url, fields)
+        return fields
+
+    def _get_content_calendar_fields(self, content: dict) -> Dict[str, Any]:
+        fields = {
+            "url": content["dav_calendar_url"],
+            "display_name": content["calendar_displayname"],
+        }
+        if "nextcloud_calendar_url" in content:
+            fields["nextcloud_calendar_url"] = content["nextcloud_calendar_url"]
+        return fields
+
+    def _compact_calendar_fields(self, contents: Dict[str, dict]) -> Dict[str, dict]:
+        """
+        Remove calendar-level fields from contents and store them once per calendar instead
+        (see `DALEC_CALDAV_COMPACT_CALENDAR_FIELDS` setting): in the database, to outlive the
+        cache, and in the cache, to not query the database for each rendered content.
+        """
+        compacted = {}
+        calendars_fields = {}
+        for content_id, content in contents.items():
+            fields = self._get_content_calendar_fields(content)
+            calendars_fields[fields["url"]] = fields
+            # contents may be shared (coalesced fetches, contents cache): they are copied
+            compacted[content_id] = {
+                key: value
+                for key, value in content.items()
+                if key not in ("calendar_displayname", "nextcloud_calendar_url")
+            }
+        for url, fields in calendars_fields.items():
+            if get_calendar_fields(url) == fields:
+                # already stored by a previous refresh
+                continue
+            instance = self.get_contents_queryset(  # type: ignore
+                CALENDAR_FIELDS_CONTENT_TYPE, "url", url
+            ).first()
+            if instance is None:
+                current_dt = now()
+                instance = self.content_model(
+                    creation_dt=current_dt,
+                    last_update_dt=current_dt,
+                    app=self.app,
+                    content_type=CALENDAR_FIELDS_CONTENT_TYPE,
+                    channel="url",
+                    channel_object=url,
+                    content_id=url,
+                    content_data=fields,
+                )
+                instance.full_clean()
+                instance.save()
+            elif instance.content_data != fields:
+                instance.content_data = fields
+                instance.last_update_dt = now()
+                instance.save(update_fields=["content_data", "last_update_dt"])
+            set_calendar_fields(url, fields)
+        return compacted
+
     def _vobject_to_dict(self, vobject: Component) -> Dict[str, Any[str, int, datetime, date]]:
         content = {}
         for key, val in vobject.contents.items():
@@ -112,62 +1130,277 @@ class CaldavProxy(Proxy):
                 content[key] = val[0].value
         return content
 
-    def _populate_content(self, event: Event, calendar_infos: Dict[str, Any]) -> dict:
-        content = self._vobject_to_dict(event.vobject_instance.vevent)
+    @timed("parse")
+    def _parse_event(self, event: CalendarObjectResource) -> Dict[str, Any]:
+        """
+        Parse the VEVENT of an event into a dict, with the fast parser if possible.
+        """
+        incr("events_parsed")
+        if app_settings.get_setting("CALDAV_FAST_PARSER", True):
+            try:
+                return parse_vevent(event.data)
+            except UnsupportedData:
+                pass
+        return self._vobject_to_dict(event.vobject_instance.vevent)
+
+    @timed("parse")
+    def _parse_events(self, event: CalendarObjectResource) -> List[Dict[str, Any]]:
+        """
+        Same as `_parse_event` but parse every VEVENT of the event (overridden or expanded
+        occurrences)
+        """
+        incr("events_parsed")
+        if app_settings.get_setting("CALDAV_FAST_PARSER", True):
+            try:
+                return parse_vevents(event.data)
+            except UnsupportedData:
+                pass
+        return [self._vobject_to_dict(vevent) for vevent in event.vobject_instance.vevent_list]
+
+    def _get_duration(self, vevent: Dict[str, Any]) -> timedelta:
+        """
+        Same as `CalendarObjectResource.get_duration` but from an already parsed VEVENT
+        """
+        if "duration" in vevent:
+            return vevent["duration"]
+        if "dtstart" in vevent and "dtend" in vevent:
+            return vevent["dtend"] - vevent["dtstart"]
+        if "dtstart" in vevent:
+            return timedelta(days=1)
+        return timedelta(0)
+
+    def _populate_contents(self, event: Event, calendar_infos: Dict[str, Any]) -> List[dict]:
+        """
+        Build contents of an event: only one for the whole event or, if recurrences are expanded
+        (see `DALEC_CALDAV_EXPAND_RECURRENCES` setting), one per occurrence in the search window
+        with at most `DALEC_CALDAV_MAX_OCCURRENCES` occurrences per event.
+        """
+        return self._populate_calendar_contents([event], calendar_infos)
+
+    @timed("populate")
+    def _populate_calendar_contents(
+        self, events: Iterable[Event], calendar_infos: Dict[str, Any]
+    ) -> List[dict]:
+        """
+        Same as `_populate_contents` for all events of a calendar at once: dates of contents
+        which are not cached are normalized in one batch (see `_normalize_contents`).
+        Contents of events are reused while their etag does not change (see
+        `DALEC_CALDAV_CONTENTS_CACHE_SIZE` setting).
+        """
+        expand = app_settings.get_setting("CALDAV_EXPAND_RECURRENCES", False)
+        contents: List[dict] = []
+        to_normalize: List[dict] = []
+        to_cache: List[Tuple[Tuple[str, ...], dict]] = []
+        for event in events:
+            if expand:
+                occurrences = self._build_occurrences(event, calendar_infos)
+                contents += occurrences
+                to_normalize += occurrences
+                continue
+            key = self._get_content_cache_key(event, calendar_infos)
+            if key is not None:
+                cached_content = contents_cache.get(key)
+                incr("contents_cache_misses" if cached_content is None else "contents_cache_hits")
+                if cached_content is not None:
+                    contents.append(dict(cached_content))
+                    continue
+            content = self._build_content(event, calendar_infos)
+            contents.append(content)
+            to_normalize.append(content)
+            if key is not None:
+                to_cache.append((key, content))
+        self._normalize_contents(to_normalize)
+        for key, content in to_cache:
+            contents_cache.set(key, dict(content))
+        return contents
+
+    def _build_occurrences(self, event: Event, calendar_infos: Dict[str, Any]) -> List[dict]:
+        """
+        Build contents (not normalized yet) of occurrences of the event in the search window
+        """
+        limit = app_settings.get_setting("CALDAV_MAX_OCCURRENCES", 100)
+        start, end = self._get_search_window(calendar_infos["url"])
+        occurrences = []
+        overridden = set()
+        masters = []
+        for vevent in self._parse_events(event):
+            if "recurrence-id" in vevent:
+                overridden.add(self._as_aware_datetime(vevent["recurrence-id"]))
+                if self._is_in_search_window(vevent, start, end):
+                    occurrences.append(vevent)
+            elif "rrule" in vevent or "rdate" in vevent:
+                masters.append(vevent)
+            else:
+                occurrences.append(vevent)
+        for master in masters:
+            # the server did not expand the event
+            occurrences += self._expand_vevent(event, master, start, end, overridden, limit)
+        occurrences.sort(key=lambda vevent: self._as_aware_datetime(vevent["dtstart"]))
+        return [
+            self._build_content(event, calendar_infos, vevent) for vevent in occurrences[:limit]
+        ]
+
+    def _get_content_cache_key(
+        self, event: Event, calendar_infos: Dict[str, Any]
+    ) -> Optional[Tuple[str, ...]]:
+        etag = event.props.get(dav.GetEtag.tag)
+        if not etag:
+            return None
+        return (
+            str(event.url),
+            etag,
+            calendar_infos["url"],
+            calendar_infos["display_name"],
+            # naive dates are made aware in the current timezone
+            get_current_timezone_name(),
+        )
+
+    def _expand_vevent(
+        self,
+        event: Event,
+        master: Dict[str, Any],
+        start: Optional[datetime],
+        end: Optional[datetime],
+        overridden: Set[datetime],
+        limit: int,
+    ) -> List[Dict[str, Any]]:
+        """
+        Client side expansion of a recurring VEVENT. Occurrences are generated lazily: only the
+        `limit` first ones in the search window are computed.
+        """
+        component = next(
+            vevent
+            for vevent in event.vobject_instance.vevent_list
+            if "recurrence-id" not in vevent.contents
+        )
+        rruleset = component.getrruleset(addRDate=True)
+        duration = self._get_duration(master)
+        all_day = not isinstance(master["dtstart"], datetime)
+        if start is None:
+            dtstarts = iter(rruleset)
+        else:
+            after = start - duration
+            if all_day or master["dtstart"].tzinfo is None:
+                # vobject generates naive occurrences for dates and floating datetimes
+                after = make_naive(after)
+            dtstarts = rruleset.xafter(after, inc=True)
+        occurrences: List[Dict[str, Any]] = []
+        for dtstart in dtstarts:
+            if len(occurrences) >= limit:
+                break
+            if end is not None and self._as_aware_datetime(dtstart) > end:
+                break
+            if self._as_aware_datetime(dtstart) in overridden:
+                continue
+            if all_day:
+                dtstart = dtstart.date()
+            occurrence = {
+                key: value
+                for key, value in master.items()
+                if key not in ("rrule", "rdate", "exrule", "exdate")
+            }
+            occurrence["dtstart"] = dtstart
+            occurrence["recurrence-id"] = dtstart
+            if "dtend" in master:
+                occurrence["dtend"] = dtstart + duration
+            occurrences.append(occurrence)
+        return occurrences
+
+    def _populate_content(
+        self,
+        event: Event,
+        calendar_infos: Dict[str, Any],
+        vevent: Optional[Dict[str, Any]] = None,
+    ) -> dict:
+        content = self._build_content(event, calendar_infos, vevent)
+        self._normalize_contents([content])
+        return content
+
+    def _build_content(
+        self,
+        event: Event,
+        calendar_infos: Dict[str, Any],
+        vevent: Optional[Dict[str, Any]] = None,
+    ) -> dict:
+        """
+        Build the content of an event (or of one of its occurrences) without the fields computed
+        from its dates: they are added by `_normalize_contents`.
+        """
+        content = self._parse_event(event) if vevent is None else dict(vevent)
         content["event_url"] = event.canonical_url
         content["dav_calendar_url"] = calendar_infos["url"]
         content["calendar_displayname"] = calendar_infos["display_name"]
-        if "created" not in content:
-            # some events accepted from an email in thunderbird can be without created info
-            dates = []
-            if "dtstamp" in content:
-                dates.append(
-                    make_aware(content["dtstamp"])
-                    if not content["dtstamp"].tzinfo
-                    else content["dtstamp"]
-                )
-            if "last-modified" in content:
-                dates.append(
-                    make_aware(content["last-modified"])
-                    if not content["last-modified"].tzinfo
-                    else content["last-modified"]
-                )
-            content["created"] = min(dates) if dates else None
-        if "last-modified" not in content:
-            content["last-modified"] = content["created"]
         if calendar_infos["type"] == "nextcloud":
             content["nextcloud_calendar_url"] = calendar_infos["nextcloud_calendar_url"]
-        duration = event.get_duration()
-        content.update(
-            {
-                "id": content["uid"],
-                "creation_dt": (
-                    make_aware(content["created"])
-                    if not content["created"].tzinfo
-                    else content["created"]
-                ),
-                "last_update_dt": (
-                    make_aware(content["last-modified"])
-                    if not content["last-modified"].tzinfo
-                    else content["last-modified"]
-                ),
-                "duration": {
-                    "days": duration.days,
-                    "seconds": duration.seconds,
-                    "total_seconds": int(duration.total_seconds()),
-                },
-            }
-        )
-        if isinstance(content["dtstart"], datetime):
-            content["start_date"] = content["dtstart"].date()
-            content["start_time"] = content["dtstart"].time()
-        else:
-            content["start_date"] = content["dtstart"]
-            content["start_time"] = None
-        if isinstance(content["dtend"], datetime):
-            content["end_date"] = content["dtend"].date()
-            content["end_time"] = content["dtend"].time()
-        else:
-            content["end_date"] = content["dtend"]
-            content["end_time"] = None
+        content_id = content["uid"]
+        if vevent is not None and "recurrence-id" in content:
+            # one content per occurrence
+            content_id += "_" + self._format_recurrence_id(content["recurrence-id"])
+        content["id"] = content_id
         return content
+
+    def _normalize_contents(self, contents: List[dict]) -> None:
+        """
+        Add (in place) fields computed from dates to a batch of contents: creation and last
+        update datetimes, duration, dates and times of start and end. The current timezone is
+        resolved once for the whole batch and naive datetimes are made aware only once.
+        Then, only properties of `DALEC_CALDAV_CONTENT_PROPERTIES` are kept.
+        """
+        current_tz = get_current_timezone()
+        aware_datetimes: Dict[datetime, datetime] = {}
+
+        def as_aware(value: datetime) -> datetime:
+            if value.tzinfo:
+                return value
+            aware_value = aware_datetimes.get(value)
+            if aware_value is None:
+                aware_value = aware_datetimes[value] = make_aware(value, current_tz)
+            return aware_value
+
+        properties = app_settings.get_setting("CALDAV_CONTENT_PROPERTIES", None)
+        kept = None if properties is None else REQUIRED_CONTENT_FIELDS.union(properties)
+        for content in contents:
+            if "created" not in content:
+                # some events accepted from an email in thunderbird can be without created info
+                dates = [
+                    as_aware(content[key])
+                    for key in ("dtstamp", "last-modified")
+                    if key in content
+                ]
+                content["created"] = min(dates) if dates else None
+            if "last-modified" not in content:
+                content["last-modified"] = content["created"]
+            dtstart = content["dtstart"]
+            dtend = content["dtend"]
+            duration = self._get_duration(content)
+            content["creation_dt"] = as_aware(content["created"])
+            content["last_update_dt"] = as_aware(content["last-modified"])
+            content["duration"] = {
+                "days": duration.days,
+                "seconds": duration.seconds,
+                "total_seconds": int(duration.total_seconds()),
+            }
+            if isinstance(dtstart, datetime):
+                content["start_date"] = dtstart.date()
+                content["start_time"] = dtstart.time()
+            else:
+                content["start_date"] = dtstart
+                content["start_time"] = None
+            if isinstance(dtend, datetime):
+                content["end_date"] = dtend.date()
+                content["end_time"] = dtend.time()
+            else:
+                content["end_date"] = dtend
+                content["end_time"] = None
+            if kept is not None:
+                for key in [key for key in content if key not in kept]:
+                    del content[key]
+
+    def _format_recurrence_id(self, value: date) -> str:
+        if isinstance(value, datetime):
+            return (
+                self._as_aware_datetime(value)
+                .astimezone(dt_timezone.utc)
+                .strftime("%Y%m%dT%H%M%SZ")
+            )
+        return value.strftime("%Y%m%d")
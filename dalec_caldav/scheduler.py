@@ -0,0 +1,90 @@
+# Future imports
+from __future__ import annotations
+
+# Standard libs
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Any, Dict, Optional, Tuple
+
+import time
+
+# DALEC imports
+from dalec import settings as app_settings
+
+# Local Apps
+from .cache import get_cache
+from .cache import make_key
+
+__all__ = ["get_refresh_interval", "is_refresh_due", "record_refresh"]
+
+
+def _get_state(
+    content_type: str, channel: Optional[str], channel_object: Optional[str]
+) -> Optional[Dict[str, Any]]:
+    return get_cache().get(make_key("schedule", content_type, channel, channel_object))
+
+
+def _get_bounds() -> Tuple[float, float]:
+    min_interval = app_settings.get_setting("CALDAV_REFRESH_MIN_INTERVAL", app_settings.TTL)
+    max_interval = app_settings.get_setting("CALDAV_REFRESH_MAX_INTERVAL", 3600)
+    return min_interval, max(min_interval, max_interval)
+
+
+def get_refresh_interval(
+    content_type: str, channel: Optional[str] = None, channel_object: Optional[str] = None
+) -> float:
+    """
+    Return the number of seconds to wait between two refreshes of the channel object, learned
+    from previous refreshes (the minimal interval if nothing was learned yet)
+    """
+    state = _get_state(content_type, channel, channel_object)
+    min_interval, max_interval = _get_bounds()
+    if state is None:
+        return min_interval
+    return min(max(state["interval"], min_interval), max_interval)
+
+
+def is_refresh_due(
+    content_type: str, channel: Optional[str] = None, channel_object: Optional[str] = None
+) -> bool:
+    """
+    Return True if the learned interval of the channel object elapsed since its last refresh
+    """
+    state = _get_state(content_type, channel, channel_object)
+    if state is None:
+        return True
+    interval = get_refresh_interval(content_type, channel, channel_object)
+    return time.time() >= state["last_refresh"] + interval
+
+
+def record_refresh(
+    content_type: str,
+    channel: Optional[str],
+    channel_object: Optional[str],
+    contents: Dict[str, dict],
+) -> None:
+    """
+    Learn the change rate of the channel object from the last modification dates of its fetched
+    contents: the refresh interval is halved each time they changed and doubled each time
+    nothing changed, between `DALEC_CALDAV_REFRESH_MIN_INTERVAL` and
+    `DALEC_CALDAV_REFRESH_MAX_INTERVAL`.
+    """
+    state = _get_state(content_type, channel, channel_object)
+    fingerprint = make_key(
+        "fingerprint",
+        *sorted("{}@{}".format(id, content["last_update_dt"]) for id, content in contents.items()),
+    )
+    changed = state is None or state["fingerprint"] != fingerprint
+    min_interval, max_interval = _get_bounds()
+    interval = get_refresh_interval(content_type, channel, channel_object)
+    interval = interval / 2 if changed else max(interval, 1) * 2
+    state = {
+        "interval": min(max(interval, min_interval), max_interval),
+        "last_refresh": time.time(),
+        "fingerprint": fingerprint,
+    }
+    # keep the state longer than the interval, otherwise quiet calendars would be polled again
+    get_cache().set(
+        make_key("schedule", content_type, channel, channel_object), state, max_interval * 2
+    )
@@ -0,0 +1,27 @@
+# Future imports
+from __future__ import annotations
+
+# Standard libs
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Any, Dict
+
+# Django imports
+from django import template
+
+# DALEC imports
+from dalec.proxy import ProxyPool
+
+register = template.Library()
+
+
+@register.filter
+def caldav_calendar(content_data: dict) -> Dict[str, Any]:
+    """
+    Return calendar-level fields (`url`, `display_name`…) of an event's content, even if they
+    are stored once per calendar (see `DALEC_CALDAV_COMPACT_CALENDAR_FIELDS` setting: only `url`
+    is returned if the calendar was not refreshed yet). ie:
+    {{ object.content_data|caldav_calendar }}
+    """
+    return ProxyPool.get("caldav").get_calendar_fields(content_data)
@@ -0,0 +1,83 @@
+# Future imports
+from __future__ import annotations
+
+# Standard libs
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, TypeVar
+
+    T = TypeVar("T")
+    R = TypeVar("R")
+
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+import threading
+
+# Django imports
+from django.utils import timezone
+
+
+def map_in_threads(func: Callable[[T], R], items: Iterable[T], max_workers: int) -> List[R]:
+    """
+    Apply `func` to every item using a pool of at most `max_workers` threads.
+    Results are returned in the same order as items, whatever the order of completion.
+    The current django timezone and context variables (ie: metrics being collected) are
+    propagated to the worker threads.
+    """
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    current_tz = timezone.get_current_timezone()
+    # a context can not be entered by several threads at once: one copy per item
+    contexts = [copy_context() for _ in items]
+
+    def run(item: T) -> R:
+        with timezone.override(current_tz):
+            return func(item)
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(lambda context, item: context.run(run, item), contexts, items))
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Deduplicate concurrent calls: while a call is in flight for a key, other threads calling
+    `do` with the same key wait for it and get its result (or its exception) instead of
+    calling their own function.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+
+    def do(self, key: Hashable, func: Callable[[], R]) -> R:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if call is None:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
@@ -0,0 +1,86 @@
+# Future imports
+from __future__ import annotations
+
+# Standard libs
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+    Target = Tuple[Optional[str], Optional[str]]
+    RefreshResult = Union[Tuple[int, int, int], Tuple[bool, bool, bool], Exception]
+
+import threading
+
+# Django imports
+from django.db import connections
+
+# DALEC imports
+from dalec import settings as app_settings
+from dalec.proxy import ProxyPool
+
+# Local Apps
+from .breaker import CircuitOpenError
+from .breaker import get_server
+from .breaker import is_open
+from .utils import map_in_threads
+
+__all__ = ["get_warmup_targets", "warmup"]
+
+
+def get_warmup_targets(content_type: str = "event") -> List[Target]:
+    """
+    Return (channel, channel_object) already refreshed once (according to dalec's fetch
+    history), ie: the ones used by templates. If there is none, return the principal's
+    calendars (no channel nor channel_object).
+    """
+    proxy = ProxyPool.get("caldav")
+    targets = list(
+        proxy.fetch_history_model.objects.filter(app=proxy.app, content_type=content_type)
+        .values_list("channel", "channel_object")
+        .order_by("channel", "channel_object")
+        .distinct()
+    )
+    return targets or [(None, None)]
+
+
+def warmup(
+    targets: Optional[Iterable[Target]] = None,
+    content_type: str = "event",
+    workers: Optional[int] = None,
+    force: bool = True,
+) -> Dict[Target, RefreshResult]:
+    """
+    Refresh contents of the given (channel, channel_object) targets (by default: the ones of
+    `get_warmup_targets`) in parallel, so the connections pool, the calendars discovery and
+    infos caches and the stored contents are ready before the first request needs them.
+
+    `workers` defaults to `DALEC_CALDAV_CONCURRENT_WORKERS` (at least 4 targets at once).
+    An error while refreshing a target does not stop the others: it is returned as its result,
+    like a `CircuitOpenError` for targets not refreshed because their server is unreachable (see
+    `DALEC_CALDAV_CIRCUIT_BREAKER_THRESHOLD` setting).
+    """
+    proxy = ProxyPool.get("caldav")
+    targets = list(targets) if targets is not None else get_warmup_targets(content_type)
+    if workers is None:
+        workers = max(app_settings.get_setting("CALDAV_CONCURRENT_WORKERS", 1), 4)
+
+    caller_thread = threading.get_ident()
+
+    def refresh(target: Target) -> RefreshResult:
+        channel, channel_object = target
+        try:
+            result = proxy.refresh(content_type, channel, channel_object, force=force)
+        except Exception as e:
+            return e
+        else:
+            server = get_server(channel, channel_object)
+            if result == (False, False, False) and is_open(server):
+                return CircuitOpenError(server)
+            return result
+        finally:
+            if threading.get_ident() != caller_thread:
+                # database connections are opened per thread
+                connections.close_all()
+
+    return dict(zip(targets, map_in_threads(refresh, targets, workers)))
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+import argparse
+import ast
+import json
+from multiprocessing import Process
+import os
+import socket
+import sys
+import tempfile
+import time
+
+import django
+from django.conf import settings
+from django.db import connection
+from django.test.utils import override_settings
+from radicale.__main__ import run as run_radicale
+
+RADICALE_CONFIG = """[server]
+hosts = {host}
+
+[storage]
+filesystem_folder = {folder}
+
+[logging]
+level = warning
+"""
+
+
+def serve(config_path):
+    sys.argv = ["radicale", "--config", config_path]
+    run_radicale()
+
+
+def wait_for(host, timeout=30):
+    hostname, port = host.rsplit(":", 1)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((hostname, int(port)), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def parse_setting(value):
+    name, _, raw_value = value.partition("=")
+    try:
+        return name, ast.literal_eval(raw_value)
+    except (ValueError, SyntaxError):
+        return name, raw_value
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark CaldavProxy.refresh against a synthetic Radicale collection"
+    )
+    parser.add_argument("--calendars", type=int, default=10, help="number of calendars")
+    parser.add_argument("--events", type=int, default=500, help="number of events per calendar")
+    parser.add_argument(
+        "--recurring", type=float, default=0.1, help="ratio of weekly recurring events"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="number of measured refreshes")
+    parser.add_argument(
+        "--setting",
+        action="append",
+        default=[],
+        type=parse_setting,
+        metavar="NAME=VALUE",
+        help="django setting to override (ie: DALEC_CALDAV_STREAMING=True)",
+    )
+    parser.add_argument("--json", metavar="PATH", help="also write measurements to this file")
+    args = parser.parse_args()
+
+    os.environ["DJANGO_SETTINGS_MODULE"] = "benchmarks.settings"
+    django.setup()
+    # Local imports need django to be set up
+    from benchmarks.collection import generate_collection
+    from benchmarks.runner import format_results
+    from benchmarks.runner import run_benchmarks
+
+    with tempfile.TemporaryDirectory(prefix="dalec_caldav_benchmarks_") as folder:
+        print(
+            "Generating {} calendars of {} events…".format(args.calendars, args.events),
+            file=sys.stderr,
+        )
+        generate_collection(folder, "test", args.calendars, args.events, args.recurring)
+        config_path = os.path.join(folder, "config")
+        with open(config_path, "w") as config_file:
+            config_file.write(
+                RADICALE_CONFIG.format(host=settings.BENCHMARKS_RADICALE_HOST, folder=folder)
+            )
+        radicale_server = Process(target=serve, args=(config_path,))
+        radicale_server.start()
+        try:
+            wait_for(settings.BENCHMARKS_RADICALE_HOST)
+            connection.creation.create_test_db(verbosity=0)
+            with override_settings(**dict(args.setting)):
+                results = run_benchmarks(repeat=args.repeat)
+        finally:
+            radicale_server.terminate()
+
+    print(format_results(results))
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(
+                {
+                    "options": {k: v for k, v in vars(args).items() if k != "setting"},
+                    "settings": {name: repr(value) for name, value in args.setting},
+                    "results": {
+                        scenario: [measurement.as_dict() for measurement in measurements]
+                        for scenario, measurements in results.items()
+                    },
+                },
+                json_file,
+                indent=2,
+            )
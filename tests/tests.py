@@ -1,22 +1,68 @@
+import asyncio
+from datetime import date
+from datetime import datetime
 from datetime import timedelta
-from importlib import reload
+from datetime import timezone
+import glob
+from io import StringIO
+import os
+from threading import Thread
+from threading import Timer
+import time
+from unittest import mock
 from unittest import skipIf
 
+from asgiref.sync import async_to_sync
 from bs4 import BeautifulSoup
+from caldav.davclient import DAVClient
+from caldav.lib.error import DAVError
+from caldav.objects import Calendar
+from caldav.objects import Event
 from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import DatabaseError
 from django.template import Context, Template
-from django.test import Client, TestCase
+from django.test import Client, TestCase, override_settings
 from django.urls import reverse
+from django.utils.timezone import get_current_timezone
+from django.utils.timezone import override as timezone_override
+import httpx
 from requests.exceptions import ConnectionError
+import vobject
 
 from dalec.proxy import ProxyPool
 from dalec.tests_utils import DalecTestCaseMixin
-from dalec_caldav import proxy
+from dalec_caldav import proxy as proxy_module
+from dalec_caldav.aio import aclients
+from dalec_caldav.breaker import get_server
+from dalec_caldav.breaker import is_open
+from dalec_caldav.cache import call_once
+from dalec_caldav.cache import contents_cache
+from dalec_caldav.cache import get_discovery
+from dalec_caldav.cache import get_snapshot
+from dalec_caldav.cache import invalidate_calendar_infos
+from dalec_caldav.cache import make_key
+from dalec_caldav.cache import set_discovery
+from dalec_caldav.cache import set_snapshot
+from dalec_caldav.clients import clients
+from dalec_caldav.dav import get_events_etags
+from dalec_caldav.dav import multiget_events
+from dalec_caldav.metrics import metrics_collected
+from dalec_caldav.parser import parse_vevent
+from dalec_caldav.parser import UnsupportedData
+from dalec_caldav.scheduler import get_refresh_interval
+from dalec_caldav.warmup import warmup
 
 __all__ = ["DalecTests"]
 
 
 class DalecTests(DalecTestCaseMixin, TestCase):
+    def setUp(self):
+        cache.clear()
+        contents_cache.clear()
+
     def _cal_url(self, cal):
         if cal == "primary":
             cal = "7eb24728-09c0-3977-4fca-e7bec231f7a0"
@@ -26,10 +72,8 @@ class DalecTests(DalecTestCaseMixin, TestCase):
 
     def test_caldav_with_wrong_url(self):
         wrong_url = "https://doesnoexist.dalec.webu.coop/"
+        dalec_caldav = ProxyPool.get("caldav")
         with self.settings(DALEC_CALDAV_BASE_URL=wrong_url):
-            ProxyPool.unregister("caldav")
-            reload(proxy)
-            dalec_caldav = ProxyPool.get("caldav")
             with self.assertRaises(ConnectionError):
                 dalec_caldav.refresh(
                     content_type="event",
@@ -37,8 +81,6 @@ class DalecTests(DalecTestCaseMixin, TestCase):
                     channel_object=wrong_url,
                     force=True,
                 )
-        ProxyPool.unregister("caldav")
-        reload(proxy)
 
     def test_retrieve_events_from_multiple_calendars(self):
         kwargs = {"app": "caldav", "content_type": "event", "channel": "url"}
@@ -197,24 +239,20 @@ class DalecTests(DalecTestCaseMixin, TestCase):
         "no extra caldavs to test. see README and local_settings.py if you want to",
     )
     def test_retrieve_events_from_other_caldavs(self):
+        dalec_caldav = ProxyPool.get("caldav")
         for name, conf in settings.DALEC_EXTRA_CALDAV_URLS.items():
-            ProxyPool.unregister("caldav")
             new_settings = {
-                "DALEC_CALDAV_BASE_URL": conf["url"],
-                "DALEC_CALDAV_API_USERNAME": conf.get("username"),
-                "DALEC_CALDAV_API_PASSWORD": conf.get("password"),
+                "DALEC_CALDAV_SERVERS": {conf["url"]: conf},
                 "DALEC_CALDAV_SERCH_EVENT_END_TIMEDELTA": timedelta(days=365),
             }
-            with self.settings(**new_settings):
-                reload(proxy)
-                dalec_caldav = ProxyPool.get("caldav")
             try:
-                nb_created, nb_updated, nb_deleted = dalec_caldav.refresh(
-                    content_type="event",
-                    channel="url",
-                    channel_object=conf["url"],
-                    force=True,
-                )
+                with self.settings(**new_settings):
+                    nb_created, nb_updated, nb_deleted = dalec_caldav.refresh(
+                        content_type="event",
+                        channel="url",
+                        channel_object=conf["url"],
+                        force=True,
+                    )
             except Exception as e:
                 raise Exception("%s error: %s" % (name, e)) from e
             qs = self.content_model.objects.filter(
@@ -227,5 +265,754 @@ class DalecTests(DalecTestCaseMixin, TestCase):
             self.assertGreaterEqual(nb_created, 1)
             self.assertEqual(nb_updated, 0)
             self.assertGreaterEqual(nb_created, qs.count())
-        ProxyPool.unregister("caldav")
-        reload(proxy)
+
+    @override_settings(DALEC_CALDAV_INCREMENTAL_SYNC=True)
+    def test_incremental_sync(self):
+        dalec_caldav = ProxyPool.get("caldav")
+        refresh_kwargs = {
+            "content_type": "event",
+            "channel": "url",
+            "channel_object": self._cal_url("primary"),
+            "force": True,
+        }
+        self.assertEqual(dalec_caldav.refresh(**refresh_kwargs), (5, 0, 0))
+
+        # ctag did not change: calendar is not searched at all
+        with mock.patch.object(Calendar, "search") as search:
+            self.assertEqual(dalec_caldav.refresh(**refresh_kwargs), (0, 0, 0))
+        search.assert_not_called()
+
+        # ctag changed but not the sync-token: sync-collection REPORT returns no change
+        cal_url = self._cal_url("primary") + "/"
+        sync_key = make_key("sync", "url", cal_url, cal_url)
+        state = cache.get(sync_key)
+        cache.set(sync_key, dict(state, ctag="outdated"))
+        with mock.patch.object(Calendar, "search") as search:
+            self.assertEqual(dalec_caldav.refresh(**refresh_kwargs), (0, 0, 0))
+        search.assert_not_called()
+
+        # sync-token refused by the server: fallback to a full search
+        cache.set(sync_key, dict(state, ctag="outdated", sync_token="outdated"))
+        with mock.patch.object(
+            Calendar, "search", autospec=True, side_effect=Calendar.search
+        ) as search:
+            dalec_caldav.refresh(**refresh_kwargs)
+        search.assert_called_once()
+
+        # stored contents were purged: every event is fetched again
+        self.content_model.objects.all().delete()
+        self.assertEqual(dalec_caldav.refresh(**refresh_kwargs), (5, 0, 0))
+
+        # the sync is not moved forward until contents are stored
+        state = cache.get(sync_key)
+        cache.set(sync_key, dict(state, ctag="outdated", sync_token="outdated"))
+        with mock.patch.object(dalec_caldav, "update_content", side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                dalec_caldav.refresh(**refresh_kwargs)
+        dalec_caldav._fetch(10, "event", "url", self._cal_url("primary"))
+        self.assertEqual(cache.get(sync_key)["ctag"], "outdated")
+        dalec_caldav.refresh(**refresh_kwargs)
+        self.assertEqual(cache.get(sync_key), state)
+
+        # contents of events deleted from the server are deleted
+        content = dalec_caldav.get_contents_queryset("event", "url", self._cal_url("primary"))[0]
+        calendar = clients.get_client().calendar(url=cal_url)
+        event = calendar.event_by_url(content.content_data["event_url"])
+        event.load()
+        data = event.data
+        event.delete()
+        # other tests rely on the same events
+        self.addCleanup(lambda: Event(calendar.client, event.url, data, calendar).save())
+        self.assertEqual(dalec_caldav.refresh(**refresh_kwargs), (0, 0, 1))
+        self.assertFalse(self.content_model.objects.filter(content_id=content.content_id).exists())
+
+    def test_concurrent_fetch(self):
+        dalec_caldav = ProxyPool.get("caldav")
+        fetch_kwargs = {"nb": 10, "content_type": "event", "channel": None, "channel_object": None}
+        sequential_contents = dalec_caldav._fetch(**fetch_kwargs)
+        with self.settings(DALEC_CALDAV_CONCURRENT_WORKERS=4):
+            concurrent_contents = dalec_caldav._fetch(**fetch_kwargs)
+        self.assertEqual(len(concurrent_contents), 6)
+        self.assertEqual(list(concurrent_contents.keys()), list(sequential_contents.keys()))
+        self.assertEqual(concurrent_contents, sequential_contents)
+
+    def test_clients_pool(self):
+        client = clients.get_client()
+        self.assertIs(clients.get_client(), client)
+        self.assertEqual(str(client.url), settings.DALEC_CALDAV_BASE_URL)
+
+        # each thread gets its own client and session but they share the same connections pool
+        thread_clients = []
+
+        def get_thread_clients():
+            thread_clients.append(clients.get_client())
+            thread_clients.append(clients.get_thread_client(client))
+
+        thread = Thread(target=get_thread_clients)
+        thread.start()
+        thread.join()
+        self.assertIsNot(thread_clients[0], client)
+        self.assertIs(thread_clients[1], thread_clients[0])
+        self.assertIsNot(thread_clients[0].session, client.session)
+        adapter = client.session.get_adapter(str(client.url))
+        self.assertIs(thread_clients[0].session.get_adapter(str(client.url)), adapter)
+
+        other_client = clients.get_client("http://localhost:5232/other/", "other", "other")
+        self.assertIsNot(other_client.session.get_adapter(str(client.url)), adapter)
+
+        with self.settings(DALEC_CALDAV_CONNECTION_POOL_SIZE=2, DALEC_CALDAV_TIMEOUT=3):
+            new_client = clients.get_client()
+            self.assertIsNot(new_client, client)
+            self.assertEqual(new_client.timeout, 3)
+            self.assertEqual(new_client.session.get_adapter(client.url)._pool_maxsize, 2)
+
+    def test_clients_for_urls(self):
+        servers = {
+            "https://nextcloud.example.com/remote.php/dav/public-calendars/": {},
+            "https://nextcloud.example.com/remote.php/dav/calendars/user/": {
+                "username": "user",
+                "password": "secret",
+            },
+        }
+        with self.settings(DALEC_CALDAV_SERVERS=servers):
+            client = clients.get_client_for_url(
+                "https://nextcloud.example.com/remote.php/dav/calendars/user/work/"
+            )
+            self.assertEqual(client.username, "user")
+            self.assertEqual(
+                str(client.url), "https://nextcloud.example.com/remote.php/dav/calendars/user/"
+            )
+            public_client = clients.get_client_for_url(
+                "https://nextcloud.example.com/remote.php/dav/public-calendars/xxx/"
+            )
+            self.assertIsNone(public_client.username)
+            url = str(client.url)
+            self.assertIsNot(
+                public_client.session.get_adapter(url), client.session.get_adapter(url)
+            )
+            # same host, same (lack of) credentials: connections are shared
+            unknown_client = clients.get_client_for_url("https://nextcloud.example.com/other/")
+            self.assertIsNone(unknown_client.username)
+            self.assertIs(
+                unknown_client.session.get_adapter(url), public_client.session.get_adapter(url)
+            )
+            # calendars of the default caldav server use the default client
+            self.assertIs(
+                clients.get_client_for_url(self._cal_url("primary")), clients.get_client()
+            )
+
+    def test_fast_parser(self):
+        calendar_dirs = os.path.join(settings.BASE_PATH, ".radicale", "collection-root", "test")
+        for path in glob.glob(os.path.join(calendar_dirs, "*", "*.ics")):
+            with open(path) as ics:
+                data = ics.read()
+            vevent = vobject.readOne(data).vevent
+            with self.subTest(path=path):
+                self.assertEqual(
+                    parse_vevent(data), ProxyPool.get("caldav")._vobject_to_dict(vevent)
+                )
+
+        data = "\n".join(
+            [
+                "BEGIN:VCALENDAR",
+                "BEGIN:VEVENT",
+                "UID:dalek",
+                "DTSTART;TZID=Skaro/Kaled:20300101T100000",
+                "END:VEVENT",
+                "END:VCALENDAR",
+            ]
+        )
+        with self.assertRaises(UnsupportedData):
+            parse_vevent(data)
+        data = data.replace("Skaro/Kaled", "Europe/Paris")
+        data = data.replace("UID:", "SUMMARY:Ex\\, Term\nUID:")
+        self.assertEqual(
+            parse_vevent(data),
+            {
+                "uid": "dalek",
+                "summary": "Ex, Term",
+                "dtstart": datetime(2030, 1, 1, 9, tzinfo=timezone.utc),
+            },
+        )
+        # only CR and LF are line breaks
+        data = data.replace("Ex\\, Term", "Ex\u2028Term:inated")
+        vevent = vobject.readOne(data).vevent
+        self.assertEqual(parse_vevent(data), ProxyPool.get("caldav")._vobject_to_dict(vevent))
+        self.assertEqual(parse_vevent(data)["summary"], "Ex\u2028Term:inated")
+
+    def test_calendar_infos_cache(self):
+        dalec_caldav = ProxyPool.get("caldav")
+        fetch_kwargs = {"nb": 10, "content_type": "event", "channel": None, "channel_object": None}
+        # display names and ctags come from the PROPFIND which lists calendars
+        with mock.patch.object(
+            Calendar, "get_properties", autospec=True, side_effect=Calendar.get_properties
+        ) as get_properties:
+            contents = dalec_caldav._fetch(**fetch_kwargs)
+            with self.settings(DALEC_CALDAV_INCREMENTAL_SYNC=True):
+                dalec_caldav._fetch(**fetch_kwargs)
+        get_properties.assert_not_called()
+        self.assertEqual(
+            {content["calendar_displayname"] for content in contents.values()},
+            {"Primary", "Secondary"},
+        )
+
+        # once cached, calendar infos are not requested again until invalidated
+        fetch_kwargs.update(channel="url", channel_object=self._cal_url("primary"))
+        with mock.patch.object(
+            Calendar, "get_properties", autospec=True, side_effect=Calendar.get_properties
+        ) as get_properties:
+            contents = dalec_caldav._fetch(**fetch_kwargs)
+            get_properties.assert_not_called()
+            invalidate_calendar_infos(next(iter(contents.values()))["dav_calendar_url"])
+            dalec_caldav._fetch(**fetch_kwargs)
+            get_properties.assert_called_once()
+
+    def test_discovery_cache(self):
+        dalec_caldav = ProxyPool.get("caldav")
+        fetch_kwargs = {"nb": 10, "content_type": "event", "channel": None, "channel_object": None}
+        contents = dalec_caldav._fetch(**fetch_kwargs)
+        client = clients.get_client()
+        discovery = get_discovery(str(client.url), client.username)
+        self.assertEqual(len(discovery["calendars"]), 2)
+
+        # calendars are not discovered again between refreshes
+        with mock.patch.object(
+            DAVClient, "propfind", autospec=True, side_effect=DAVClient.propfind
+        ) as propfind:
+            self.assertEqual(dalec_caldav._fetch(**fetch_kwargs), contents)
+        propfind.assert_not_called()
+
+        # a cached calendar does not exist anymore: calendars are discovered again
+        missing_calendar = {"url": self._cal_url("deleted") + "/", "name": "Deleted"}
+        discovery["calendars"].append(missing_calendar)
+        set_discovery(str(client.url), client.username, discovery)
+        self.assertEqual(dalec_caldav._fetch(**fetch_kwargs), contents)
+        discovery = get_discovery(str(client.url), client.username)
+        self.assertNotIn(missing_calendar, discovery["calendars"])
+
+    def test_expand_recurrences(self):
+        overridden = (datetime.now(timezone.utc) + timedelta(days=2)).replace(
+            hour=10, minute=0, second=0, microsecond=0
+        )
+        ical = "\n".join(
+            [
+                "BEGIN:VCALENDAR",
+                "VERSION:2.0",
+                "PRODID:-//dalec//tests//EN",
+                "BEGIN:VEVENT",
+                "UID:daily-dalek",
+                "DTSTAMP:20200101T000000Z",
+                "DTSTART:20200101T100000Z",
+                "DTEND:20200101T110000Z",
+                "RRULE:FREQ=DAILY",
+                "SUMMARY:Exterminate",
+                "END:VEVENT",
+                "BEGIN:VEVENT",
+                "UID:daily-dalek",
+                "DTSTAMP:20200101T000000Z",
+                "RECURRENCE-ID:{:%Y%m%dT%H%M%SZ}".format(overridden),
+                "DTSTART:{:%Y%m%dT%H%M%SZ}".format(overridden + timedelta(hours=2)),
+                "DTEND:{:%Y%m%dT%H%M%SZ}".format(overridden + timedelta(hours=3)),
+                "SUMMARY:Exterminate later",
+                "END:VEVENT",
+                "END:VCALENDAR",
+            ]
+        )
+        calendar = clients.get_client().calendar(url=self._cal_url("secondary") + "/")
+        event = calendar.save_event(ical)
+        self.addCleanup(event.delete)
+        dalec_caldav = ProxyPool.get("caldav")
+        fetch_kwargs = {
+            "nb": 10,
+            "content_type": "event",
+            "channel": "url",
+            "channel_object": self._cal_url("secondary"),
+        }
+        calendar_infos = dalec_caldav._get_calendar_infos(calendar)
+        for server_side in (True, False):
+            with self.subTest(server_side=server_side), self.settings(
+                DALEC_CALDAV_EXPAND_RECURRENCES=True, DALEC_CALDAV_MAX_OCCURRENCES=5
+            ):
+                if server_side:
+                    contents = dalec_caldav._fetch(**fetch_kwargs)
+                    contents = [c for c in contents.values() if c["uid"] == "daily-dalek"]
+                else:
+                    # the master event, as returned by servers which do not support expand
+                    contents = dalec_caldav._populate_contents(event, calendar_infos)
+                self.assertEqual(len(contents), 5)
+                self.assertEqual(len({content["id"] for content in contents}), 5)
+                self.assertIn(
+                    "daily-dalek_{:%Y%m%dT%H%M%SZ}".format(overridden),
+                    [content["id"] for content in contents],
+                )
+                self.assertEqual(
+                    [content["summary"] for content in contents].count("Exterminate later"), 1
+                )
+
+        # without expansion the recurring event is only one content
+        contents = dalec_caldav._fetch(**fetch_kwargs)
+        self.assertEqual(contents["daily-dalek"]["summary"], "Exterminate")
+
+    def test_limit_to_nb(self):
+        dalec_caldav = ProxyPool.get("caldav")
+        fetch_kwargs = {"nb": 2, "content_type": "event", "channel": None, "channel_object": None}
+        all_contents = dalec_caldav._fetch(**fetch_kwargs)
+        self.assertEqual(len(all_contents), 6)
+
+        with self.settings(DALEC_CALDAV_LIMIT_TO_NB=True), mock.patch.object(
+            Calendar, "search"
+        ) as search, mock.patch.object(
+            dalec_caldav, "_parse_event", wraps=dalec_caldav._parse_event
+        ) as parse_event:
+            contents = dalec_caldav._fetch(**fetch_kwargs)
+        search.assert_not_called()
+        self.assertEqual(parse_event.call_count, 2)
+        # the same events as dalec keeps: the last updated ones
+        expected = sorted(all_contents.values(), key=lambda c: c["last_update_dt"], reverse=True)
+        self.assertEqual(set(contents), {content["id"] for content in expected[:2]})
+        for content_id, content in contents.items():
+            self.assertEqual(content, all_contents[content_id])
+
+    def test_multiget_events(self):
+        calendar = clients.get_client().calendar(url=self._cal_url("primary") + "/")
+        urls = [url for url, _, _ in get_events_etags(calendar, None, None)]
+        self.assertGreater(len(urls), 10)
+        urls.append(calendar.url.join("exterminated.ics"))
+        with mock.patch.object(
+            DAVClient, "report", autospec=True, side_effect=DAVClient.report
+        ) as report:
+            events = multiget_events(calendar, urls, chunk_size=5)
+        self.assertEqual(report.call_count, (len(urls) + 4) // 5)
+        self.assertEqual(
+            sorted(str(event.url) for event in events), sorted(str(url) for url in urls[:-1])
+        )
+        self.assertTrue(all(event.data and event.props for event in events))
+
+    def test_contents_cache(self):
+        dalec_caldav = ProxyPool.get("caldav")
+        fetch_kwargs = {
+            "nb": 10,
+            "content_type": "event",
+            "channel": "url",
+            "channel_object": self._cal_url("primary"),
+        }
+        contents = dalec_caldav._fetch(**fetch_kwargs)
+        self.assertEqual((contents_cache.hits, contents_cache.misses), (0, len(contents)))
+
+        # unchanged events are not parsed again, even from another channel
+        with mock.patch.object(
+            dalec_caldav, "_parse_event", wraps=dalec_caldav._parse_event
+        ) as parse_event:
+            self.assertEqual(dalec_caldav._fetch(**fetch_kwargs), contents)
+            fetch_kwargs.update(channel=None, channel_object=None)
+            self.assertEqual(len(dalec_caldav._fetch(**fetch_kwargs)), 6)
+        self.assertEqual(parse_event.call_count, 1)
+        self.assertEqual(contents_cache.hits, len(contents) * 2)
+
+        with self.settings(DALEC_CALDAV_CONTENTS_CACHE_SIZE=2):
+            dalec_caldav._fetch(**fetch_kwargs)
+            self.assertEqual(len(contents_cache), 2)
+
+    def test_async_fetch(self):
+        dalec_caldav = ProxyPool.get("caldav")
+
+        async def afetch(**fetch_kwargs):
+            try:
+                return await dalec_caldav._afetch(**fetch_kwargs)
+            finally:
+                await aclients.aclose()
+
+        for channel, channel_object in ((None, None), ("url", self._cal_url("primary"))):
+            fetch_kwargs = {
+                "nb": 10,
+                "content_type": "event",
+                "channel": channel,
+                "channel_object": channel_object,
+            }
+            with self.subTest(channel=channel):
+                cache.clear()
+                contents = asyncio.run(afetch(**fetch_kwargs))
+                self.assertEqual(contents, dalec_caldav._fetch(**fetch_kwargs))
+
+        refresh_kwargs = {"content_type": "event", "channel": None, "channel_object": None}
+        aclose = httpx.AsyncClient.aclose
+        with mock.patch.object(httpx.AsyncClient, "aclose", autospec=True, side_effect=aclose):
+            self.assertEqual(async_to_sync(dalec_caldav.arefresh)(**refresh_kwargs), (6, 0, 0))
+            # connections are closed: the event loop of async_to_sync does not outlive the refresh
+            httpx.AsyncClient.aclose.assert_called_once()
+        self.assertEqual(async_to_sync(dalec_caldav.arefresh)(**refresh_kwargs), (False,) * 3)
+        self.assertEqual(len(dalec_caldav.get_contents_queryset(**refresh_kwargs)), 6)
+
+    def test_streaming(self):
+        dalec_caldav = ProxyPool.get("caldav")
+        for channel, channel_object in ((None, None), ("url", self._cal_url("primary"))):
+            fetch_kwargs = {
+                "nb": 10,
+                "content_type": "event",
+                "channel": channel,
+                "channel_object": channel_object,
+            }
+            with self.subTest(channel=channel):
+                contents = dalec_caldav._fetch(**fetch_kwargs)
+                # the multistatus response is not loaded at once by DAVClient
+                with self.settings(DALEC_CALDAV_STREAMING=True), mock.patch.object(
+                    DAVClient, "report"
+                ) as report:
+                    self.assertEqual(dalec_caldav._fetch(**fetch_kwargs), contents)
+                report.assert_not_called()
+
+    def test_search_windows(self):
+        dalec_caldav = ProxyPool.get("caldav")
+        fetch_kwargs = {"nb": 10, "content_type": "event", "channel": None, "channel_object": None}
+        self.assertEqual(len(dalec_caldav._fetch(**fetch_kwargs)), 6)
+        # an empty window for the secondary calendar only
+        windows = {self._cal_url("secondary"): {"start": timedelta(0), "end": timedelta(0)}}
+        with self.settings(DALEC_CALDAV_SEARCH_WINDOWS=windows):
+            contents = dalec_caldav._fetch(**fetch_kwargs)
+        self.assertEqual(len(contents), 5)
+        self.assertNotIn("Secondary", [c["calendar_displayname"] for c in contents.values()])
+
+    @override_settings(
+        DALEC_CALDAV_ADAPTIVE_REFRESH=True,
+        DALEC_CALDAV_REFRESH_MIN_INTERVAL=0,
+        DALEC_CALDAV_REFRESH_MAX_INTERVAL=60,
+    )
+    def test_adaptive_refresh(self):
+        dalec_caldav = ProxyPool.get("caldav")
+        refresh_kwargs = {"content_type": "event", "channel": "url", "channel_object": None}
+
+        def refresh(**kwargs):
+            # only the adaptive scheduler should prevent the refresh, not dalec's TTL
+            self.fetch_history_model.objects.all().delete()
+            return dalec_caldav.refresh(**refresh_kwargs, **kwargs)
+
+        self.assertEqual(refresh(), (6, 0, 0))
+        self.assertEqual(get_refresh_interval(**refresh_kwargs), 0)
+        # no event changed: the calendar is considered as quiet
+        refresh()
+        self.assertEqual(get_refresh_interval(**refresh_kwargs), 2)
+        with mock.patch.object(dalec_caldav, "_fetch") as fetch:
+            self.assertEqual(refresh(), (False, False, False))
+        fetch.assert_not_called()
+        refresh(force=True)
+        self.assertEqual(get_refresh_interval(**refresh_kwargs), 4)
+
+    def test_coalesce_requests(self):
+        dalec_caldav = ProxyPool.get("caldav")
+        fetch_kwargs = {"nb": 10, "content_type": "event", "channel": None, "channel_object": None}
+        fetch_event = dalec_caldav._fetch_event
+
+        def slow_fetch_event(*args):
+            time.sleep(0.2)
+            return fetch_event(*args)
+
+        def fetch_in_timezone():
+            with timezone_override("Asia/Tokyo"):
+                dalec_caldav._fetch(**fetch_kwargs)
+
+        results = []
+        with mock.patch.object(
+            dalec_caldav, "_fetch_event", side_effect=slow_fetch_event
+        ) as mocked_fetch_event:
+            threads = [
+                Thread(target=lambda: results.append(dalec_caldav._fetch(**fetch_kwargs)))
+                for _ in range(3)
+            ]
+            # contents depend on the current timezone: they are not shared
+            threads.append(Thread(target=fetch_in_timezone))
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(mocked_fetch_event.call_count, 2)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(len(results[0]), 6)
+        self.assertEqual(results[0], results[1])
+        # each caller can update its own contents
+        self.assertIsNot(results[0], results[1])
+
+    def test_coalesce_across_processes(self):
+        func = mock.Mock(return_value="fetched")
+        self.assertEqual(call_once("key", func, 1), "fetched")
+        func.assert_called_once()
+        func.reset_mock()
+
+        # another process holds the lock and shares its result a bit later
+        cache.add(make_key("lock", "key"), "other", 10)
+        timer = Timer(0.1, lambda: cache.set(make_key("result", "key", "other"), "shared"))
+        timer.start()
+        self.assertEqual(call_once("key", func, 1), "shared")
+        func.assert_not_called()
+
+        # the owner is too slow
+        cache.add(make_key("lock", "key2"), "other", 10)
+        self.assertEqual(call_once("key2", func, 0.2), "fetched")
+        func.assert_called_once()
+
+    @override_settings(DALEC_CALDAV_CONCURRENT_WORKERS=2)
+    def test_metrics(self):
+        dalec_caldav = ProxyPool.get("caldav")
+        fetch_kwargs = {"nb": 10, "content_type": "event", "channel": None, "channel_object": None}
+        receiver = mock.Mock()
+        metrics_collected.connect(receiver)
+        self.addCleanup(metrics_collected.disconnect, receiver)
+
+        dalec_caldav._fetch(**fetch_kwargs)
+        receiver.assert_called_once()
+        kwargs = receiver.call_args[1]
+        self.assertEqual(kwargs["sender"], dalec_caldav.__class__)
+        self.assertEqual(kwargs["content_type"], "event")
+        timings, counters = kwargs["metrics"]["timings"], kwargs["metrics"]["counters"]
+        for phase in ("total", "discovery", "calendar_infos", "report", "populate", "parse"):
+            self.assertIn(phase, timings)
+        # requests sent from worker threads are counted too
+        self.assertGreaterEqual(counters["requests"], 4)
+        self.assertGreater(counters["bytes_sent"], 0)
+        self.assertGreater(counters["bytes_received"], 0)
+        self.assertEqual(counters["events_parsed"], 6)
+        self.assertEqual(counters["discovery_cache_misses"], 1)
+        self.assertEqual(counters["contents_cache_misses"], 6)
+
+        callback = mock.Mock()
+        with self.settings(
+            DALEC_CALDAV_METRICS_CALLBACK=callback, DALEC_CALDAV_METRICS_LOGGING=True
+        ):
+            with self.assertLogs("dalec_caldav.metrics", "INFO"):
+                dalec_caldav._fetch(**fetch_kwargs)
+        callback.assert_called_once()
+        counters = callback.call_args[1]["metrics"]["counters"]
+        self.assertEqual(counters["discovery_cache_hits"], 1)
+
+    @override_settings(
+        DALEC_CALDAV_CONTENT_PROPERTIES=["summary"], DALEC_CALDAV_COMPACT_CALENDAR_FIELDS=True
+    )
+    def test_compact_contents(self):
+        dalec_caldav = ProxyPool.get("caldav")
+        fetch_kwargs = {"nb": 10, "content_type": "event", "channel": None, "channel_object": None}
+        contents = dalec_caldav._fetch(**fetch_kwargs)
+        self.assertEqual(len(contents), 6)
+        content = next(c for c in contents.values() if c["uid"].startswith("88bb03ce"))
+        self.assertEqual(content["summary"], "The Christmas Invasion")
+        for key in ("calendar_displayname", "dtstamp", "transp", "created"):
+            self.assertNotIn(key, content)
+
+        template = Template("{% load dalec_caldav %}{{ content|caldav_calendar }}")
+        with mock.patch.object(Calendar, "get_property") as get_property:
+            output = template.render(Context({"content": content}))
+        get_property.assert_not_called()
+        self.assertIn("Secondary", output)
+        # calendar fields evicted from the cache are read from the database, never fetched
+        # while rendering templates
+        cache.clear()
+        calendar_qs = dalec_caldav.get_contents_queryset(
+            "calendar", "url", content["dav_calendar_url"]
+        )
+        with mock.patch("requests.adapters.HTTPAdapter.send") as send:
+            fields = dalec_caldav.get_calendar_fields(content)
+            self.assertEqual(fields["display_name"], "Secondary")
+            calendar_qs.delete()
+            cache.clear()
+            fields = dalec_caldav.get_calendar_fields(content)
+        send.assert_not_called()
+        self.assertEqual(fields, {"url": content["dav_calendar_url"]})
+        # but stored again by the next refresh, even if calendar infos are cached
+        dalec_caldav._fetch(**fetch_kwargs)
+        calendar_qs.delete()
+        cache.delete(make_key("calendar", content["dav_calendar_url"]))
+        dalec_caldav._fetch(**fetch_kwargs)
+        self.assertEqual(calendar_qs.count(), 1)
+        fields = dalec_caldav.get_calendar_fields(content)
+        self.assertEqual(fields["display_name"], "Secondary")
+        self.assertEqual(fields["url"], content["dav_calendar_url"])
+
+    @override_settings(DALEC_CALDAV_CONTENTS_CACHE_SIZE=0)
+    def test_batch_normalization(self):
+        dalec_caldav = ProxyPool.get("caldav")
+        calendar = next(
+            calendar
+            for calendar in clients.get_client().principal().calendars()
+            if "7eb24728" in str(calendar.url)
+        )
+        events = dalec_caldav._get_events(calendar)
+        calendar_infos = dalec_caldav._get_calendar_infos(calendar)
+        with mock.patch(
+            "dalec_caldav.proxy.get_current_timezone", wraps=get_current_timezone
+        ) as mocked_get_current_timezone:
+            contents = dalec_caldav._populate_calendar_contents(events, calendar_infos)
+        # the timezone is resolved once for the whole batch
+        mocked_get_current_timezone.assert_called_once()
+        # same contents as when events are populated one by one
+        self.assertEqual(
+            contents,
+            [dalec_caldav._populate_content(event, calendar_infos) for event in events],
+        )
+        content = next(c for c in contents if c["uid"].startswith("04bbb7da"))
+        # LAST-MODIFIED of this event is a naive datetime
+        self.assertIsNotNone(content["last_update_dt"].tzinfo)
+        self.assertEqual(content["duration"]["total_seconds"], 86400)
+        self.assertEqual(content["start_date"], date(2035, 7, 2))
+        self.assertIsNone(content["start_time"])
+
+    @override_settings(DALEC_CALDAV_DELTA=True)
+    def test_delta(self):
+        dalec_caldav = ProxyPool.get("caldav")
+        refresh_kwargs = {"content_type": "event", "channel": "url", "channel_object": None}
+        self.assertEqual(dalec_caldav.refresh(**refresh_kwargs), (6, 0, 0))
+        qs = dalec_caldav.get_contents_queryset(**refresh_kwargs)
+        content_ids = set(qs.values_list("content_id", flat=True))
+        # nothing changed: no content is given to dalec
+        with mock.patch.object(dalec_caldav, "update_content") as update_content:
+            self.assertEqual(dalec_caldav.refresh(**refresh_kwargs, force=True), (0, 0, 0))
+        update_content.assert_not_called()
+
+        # one content changed and another one was deleted from the server since the snapshot
+        snapshot = get_snapshot(**refresh_kwargs)
+        changed_id = next(iter(snapshot))
+        snapshot[changed_id] = "outdated"
+        snapshot["deleted"] = "deleted"
+        set_snapshot(snapshot=snapshot, **refresh_kwargs)
+        dalec_caldav.create_content(
+            content={
+                "id": "deleted",
+                "creation_dt": datetime(2000, 1, 1, tzinfo=timezone.utc),
+                "last_update_dt": datetime(2000, 1, 1, tzinfo=timezone.utc),
+            },
+            **refresh_kwargs,
+        )
+        with mock.patch.object(
+            dalec_caldav, "update_content", wraps=dalec_caldav.update_content
+        ) as update_content:
+            self.assertEqual(dalec_caldav.refresh(**refresh_kwargs, force=True), (0, 1, 1))
+        update_content.assert_called_once()
+        self.assertEqual(update_content.call_args[1]["instance"].content_id, changed_id)
+        self.assertEqual(set(qs.values_list("content_id", flat=True)), content_ids)
+
+        # contents deleted from the database are given to dalec again
+        qs.filter(content_id=changed_id).delete()
+        self.assertEqual(dalec_caldav.refresh(**refresh_kwargs, force=True), (1, 0, 0))
+        qs.all().delete()
+        self.assertEqual(dalec_caldav.refresh(**refresh_kwargs, force=True), (6, 0, 0))
+        self.assertEqual(set(qs.values_list("content_id", flat=True)), content_ids)
+
+    def test_warmup(self):
+        dalec_caldav = ProxyPool.get("caldav")
+        # nothing was refreshed yet: the principal's calendars are warmed up
+        self.assertEqual(warmup(), {(None, None): (6, 0, 0)})
+        self.assertIsNotNone(get_discovery(settings.DALEC_CALDAV_BASE_URL, "test"))
+
+        url = self._cal_url("secondary")
+        stdout, stderr = StringIO(), StringIO()
+        call_command("dalec_caldav_warmup", url, stdout=stdout, stderr=stderr)
+        self.assertIn("url {}: 1 created, 0 updated, 0 deleted".format(url), stdout.getvalue())
+        self.assertEqual(
+            dalec_caldav.get_contents_queryset("event", "url", url).count(),
+            1,
+        )
+        # targets already refreshed are warmed up by default
+        with mock.patch.object(dalec_caldav, "refresh", return_value=(0, 0, 0)) as refresh:
+            call_command("dalec_caldav_warmup", "--workers", "1", stdout=stdout)
+        self.assertEqual(
+            {call[0][1:3] for call in refresh.call_args_list}, {(None, None), ("url", url)}
+        )
+        with mock.patch.object(dalec_caldav, "refresh", side_effect=ConnectionError):
+            with self.assertRaises(CommandError):
+                call_command("dalec_caldav_warmup", url, stdout=stdout, stderr=stderr)
+
+    @override_settings(
+        DALEC_CALDAV_CIRCUIT_BREAKER_THRESHOLD=2, DALEC_CALDAV_CIRCUIT_BREAKER_BACKOFF=60
+    )
+    def test_circuit_breaker(self):
+        dalec_caldav = ProxyPool.get("caldav")
+        url = self._cal_url("secondary")
+        server = get_server("url", url)
+        self.assertEqual(dalec_caldav.refresh("event", "url", url), (1, 0, 0))
+
+        def slow_fetch_event(*args):
+            time.sleep(0.2)
+            raise ConnectionError
+
+        errors = []
+
+        def refresh():
+            try:
+                dalec_caldav.refresh("event", "url", url, force=True)
+            except ConnectionError as e:
+                errors.append(e)
+
+        with mock.patch.object(
+            dalec_caldav, "_fetch_event", side_effect=slow_fetch_event
+        ) as fetch_event, mock.patch.object(dalec_caldav, "_start_probe") as start_probe:
+            # callers sharing the same fetch count only one failure
+            threads = [Thread(target=refresh) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(errors), 3)
+            self.assertFalse(is_open(server))
+            with self.assertRaises(ConnectionError):
+                dalec_caldav.refresh("event", "url", url, force=True)
+            self.assertTrue(is_open(server))
+            # the server is not queried anymore and stored contents are kept
+            self.assertEqual(
+                dalec_caldav.refresh("event", "url", url, force=True), (False, False, False)
+            )
+            self.assertEqual(fetch_event.call_count, 2)
+            self.assertEqual(dalec_caldav.get_contents_queryset("event", "url", url).count(), 1)
+            # the warm-up reports the open circuit instead of "not expired"
+            stdout, stderr = StringIO(), StringIO()
+            with self.assertRaises(CommandError):
+                call_command("dalec_caldav_warmup", url, stdout=stdout, stderr=stderr)
+            self.assertIn("circuit open, {} is unreachable".format(server), stderr.getvalue())
+            self.assertNotIn("not expired", stdout.getvalue())
+            start_probe.assert_not_called()
+            # once the backoff delay elapsed, only one probe is started
+            with mock.patch("dalec_caldav.breaker.time.time", return_value=time.time() + 61):
+                dalec_caldav.refresh("event", "url", url, force=True)
+                dalec_caldav.refresh("event", "url", url, force=True)
+            start_probe.assert_called_once()
+
+        class SyncThread:
+            def __init__(self, target, **kwargs):
+                self.target = target
+
+            def start(self):
+                self.target()
+
+        cache.delete(make_key("probe", server))
+        # the probe succeeds: the circuit is closed
+        with mock.patch("dalec_caldav.breaker.time.time", return_value=time.time() + 61):
+            with mock.patch.object(proxy_module, "threading", mock.Mock(Thread=SyncThread)):
+                with mock.patch.object(proxy_module, "connections"):
+                    dalec_caldav.refresh("event", "url", url, force=True)
+        self.assertFalse(is_open(server))
+
+        with mock.patch.object(dalec_caldav, "_fetch_event", side_effect=ConnectionError):
+            for _ in range(2):
+                with self.assertRaises(ConnectionError):
+                    dalec_caldav.refresh("event", "url", url, force=True)
+        self.assertTrue(is_open(server))
+        with mock.patch.object(
+            proxy_module, "threading", mock.Mock(Thread=SyncThread)
+        ), mock.patch.object(proxy_module, "connections"):
+            # a probe failing with an HTTP error keeps the circuit open
+            with mock.patch(
+                "dalec_caldav.breaker.time.time", return_value=time.time() + 61
+            ), mock.patch.object(dalec_caldav, "_fetch_event", side_effect=DAVError):
+                dalec_caldav.refresh("event", "url", url, force=True)
+            self.assertTrue(is_open(server))
+            # unexpected errors are not hidden by probes
+            with mock.patch(
+                "dalec_caldav.breaker.time.time", return_value=time.time() + 3600
+            ), mock.patch.object(dalec_caldav, "_fetch_event", side_effect=ValueError):
+                with self.assertRaises(ValueError):
+                    dalec_caldav.refresh("event", "url", url, force=True)
+
+    def test_circuit_breaker_disabled(self):
+        dalec_caldav = ProxyPool.get("caldav")
+        url = self._cal_url("secondary")
+        with mock.patch.object(dalec_caldav, "_fetch_event", side_effect=ConnectionError):
+            for _ in range(5):
+                with self.assertRaises(ConnectionError):
+                    dalec_caldav.refresh("event", "url", url, force=True)
+        self.assertFalse(is_open(get_server("url", url)))